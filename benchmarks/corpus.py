@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Gera um corpus sintético de imagens JPEG para os benchmarks do iptcinfo.
+
+Uso: python benchmarks/corpus.py pasta [quantidade] [semente]
+
+As imagens não são fotos de verdade: têm os marcadores de um JPEG
+(SOI, APPn, DQT, SOF, DHT, SOS, EOI) e bytes aleatórios como dados da
+imagem, o que basta para o iptcinfo. Variam o tamanho da imagem, o número
+de segmentos APP, o tamanho do bloco IIM, o charset (UTF-8 declarado no
+registro 1:90 ou Latin-1 sem declaração) e a presença do bloco do
+Photoshop (APP13) com e sem outros recursos além do IIM.
+'''
+
+import os
+import random
+import sys
+from struct import pack
+
+# Tamanhos dos dados da imagem
+BODY_SIZES = (20 * 1024, 200 * 1024, 2 * 1024 * 1024)
+
+# Palavras para os textos, com acentos para exercitar os charsets
+WORDS = [u'mar', u'praia', u'costão', u'larva', u'véliger', u'plâncton',
+        u'São Sebastião', u'Ubatuba', u'molusco', u'poliqueta', u'ascídia',
+        u'água', u'maré', u'cnidário', u'medusa', u'ctenóforo']
+
+
+def segment(marker, payload):
+    '''Segmento JPEG com marcador e tamanho.'''
+    return pack('!BBH', 0xff, marker, len(payload) + 2) + payload
+
+
+def resource(id, data, name=''):
+    '''Recurso 8BIM do Photoshop, com nome pascal e preenchimento par.'''
+    pname = pack('B', len(name)) + name
+    if len(pname) % 2:
+        pname += '\0'
+    block = '8BIM' + pack('!H', id) + pname + pack('!L', len(data)) + data
+    if len(data) % 2:
+        block += '\0'
+    return block
+
+
+def iim(fields, utf8=True):
+    '''Bloco IIM com os datasets (número, texto unicode) do registro 2.'''
+    out = []
+    if utf8:
+        # 1:90 com o código 196 (utf_8), como o iptcinfo grava o charset
+        out.append(pack('!BBBHH', 0x1c, 1, 90, 4, 196))
+    out.append(pack('!BBBHH', 0x1c, 2, 0, 2, 4))
+    for dataset, text in fields:
+        value = text.encode(utf8 and 'utf-8' or 'latin-1')
+        out.append(pack('!BBBH', 0x1c, 2, dataset, len(value)) + value)
+    return ''.join(out)
+
+
+def fields(rnd, keywords, caption):
+    '''Datasets IPTC com keywords palavras-chave e legenda de caption
+    palavras.'''
+    text = lambda n: u' '.join([rnd.choice(WORDS) for i in xrange(n)])
+    out = [(5, text(3)), (80, text(2)), (90, rnd.choice(WORDS)),
+            (105, text(2)), (116, u'CEBIMar/USP'), (120, text(caption))]
+    for i in xrange(keywords):
+        out.append((25, u'%s %d' % (rnd.choice(WORDS), i)))
+    return out
+
+
+def exif(rnd):
+    '''Segmento APP1 com EXIF mínimo: orientação e data.'''
+    date = '20%02d:%02d:%02d 12:00:00\0' % (rnd.randint(0, 13),
+            rnd.randint(1, 12), rnd.randint(1, 28))
+    ifd = pack('>H', 2)
+    ifd += pack('>HHLHH', 0x0112, 3, 1, rnd.choice((1, 6, 8)), 0)
+    ifd += pack('>HHLL', 0x0132, 2, 20, 8 + 2 + 24 + 4)
+    ifd += pack('>L', 0)
+    return segment(0xe1, 'Exif\0\0' + 'MM\0\x2a' + pack('>L', 8) + ifd + date)
+
+
+def jpeg(rnd, body, app_segments=0, keywords=10, caption=20, utf8=True,
+        photoshop=True, resources=True, progressive=False, exif_app1=True):
+    '''Um JPEG sintético; photoshop=False gera sem APP13 e exif_app1=False
+    sem APP1.'''
+    parts = ['\xff\xd8', segment(0xe0, 'JFIF\0\x01\x02' + '\0' * 7)]
+    if exif_app1:
+        parts.append(exif(rnd))
+    for i in xrange(app_segments):
+        # APP2 (ICC) e APP14 (Adobe) de tamanhos variados
+        marker = rnd.choice((0xe2, 0xee))
+        parts.append(segment(marker, os.urandom(rnd.randint(16, 8192))))
+    if photoshop:
+        data = 'Photoshop 3.0\0'
+        if resources:
+            data += resource(0x03ed, '\0' * 16)
+            # Miniatura sem bytes 0x1C: a busca cega do iptcinfo pelo
+            # início do IIM poderia achar um falso registro nela
+            thumb = os.urandom(rnd.randint(1000, 20000)).replace('\x1c', '\0')
+            data += resource(0x040c, thumb)
+        data += resource(0x0404, iim(fields(rnd, keywords, caption), utf8))
+        parts.append(segment(0xed, data))
+    parts.append(segment(0xdb, '\0' * 65))
+    width, height = rnd.choice(((640, 480), (1600, 1200), (4000, 3000)))
+    frame = pack('!BHHB', 8, height, width, 3)
+    for i in xrange(3):
+        frame += pack('BBB', i + 1, 0x11, 0)
+    parts.append(segment(progressive and 0xc2 or 0xc0, frame))
+    parts.append(segment(0xc4, '\0' * 30))
+    parts.append(segment(0xda, '\x01\x01\x00\x00\x3f\x00'))
+    # Dados da imagem sem 0xFF, como num JPEG com byte stuffing
+    parts.append(os.urandom(body).replace('\xff', '\x00'))
+    parts.append('\xff\xd9')
+    return ''.join(parts)
+
+
+def variants(rnd):
+    '''Sorteia os parâmetros de uma imagem do corpus.'''
+    photoshop = rnd.random() > 0.15
+    return {
+            'body': rnd.choice(BODY_SIZES),
+            'app_segments': rnd.randint(0, 8),
+            'keywords': rnd.choice((0, 5, 30, 200)),
+            'caption': rnd.choice((5, 50, 500)),
+            'utf8': rnd.random() > 0.3,
+            'photoshop': photoshop,
+            'resources': photoshop and rnd.random() > 0.5,
+            'progressive': rnd.random() > 0.8,
+            }
+
+
+def generate(folder, count=200, seed=1):
+    '''Cria count imagens na pasta e retorna a lista de caminhos.
+
+    O mesmo seed gera os mesmos parâmetros (os bytes aleatórios da imagem
+    mudam), para comparar rodadas.
+    '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rnd = random.Random(seed)
+    paths = []
+    for n in xrange(count):
+        filepath = os.path.join(folder, 'corpus%05d.jpg' % n)
+        data = jpeg(rnd, **variants(rnd))
+        out = open(filepath, 'wb')
+        out.write(data)
+        out.close()
+        paths.append(filepath)
+    return paths
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(2)
+    paths = generate(sys.argv[1], *[int(arg) for arg in sys.argv[2:4]])
+    print '%d imagens em %s' % (len(paths), sys.argv[1])
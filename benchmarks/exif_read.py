@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compara a leitura de GPS e data do EXIF: iptcinfo.readExif x pyexiv2.
+
+Uso: python benchmarks/exif_read.py pasta_com_fotos [repetições]
+
+Lê todas as imagens JPEG da pasta (recursivamente) com os dois métodos,
+confere se os valores batem e mostra o tempo de cada um.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from iptcinfo import readExif, gpsInfo, c_exif_gps, c_exif_dates
+
+try:
+    import pyexiv2
+except ImportError:
+    pyexiv2 = None
+
+
+def corpus(folder):
+    '''Lista as imagens JPEG da pasta.'''
+    files = []
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                files.append(os.path.join(root, name))
+    return files
+
+
+def with_iptcinfo(filepath):
+    '''GPS e data com o decodificador do iptcinfo.'''
+    exif = readExif(filepath, c_exif_gps + c_exif_dates)
+    dates = [exif[key] for key in c_exif_dates if key in exif]
+    return gpsInfo(exif), dates and dates[0] or False
+
+
+def with_pyexiv2(filepath):
+    '''GPS e data com o pyexiv2, como o DockGeo fazia.'''
+    exif = pyexiv2.ImageMetadata(unicode(filepath))
+    exif.read()
+    values = {}
+    for key in c_exif_gps + c_exif_dates:
+        try:
+            values[key] = exif[key].value
+        except KeyError:
+            pass
+    dates = [values[key] for key in c_exif_dates if key in values]
+    return gpsInfo(values), dates and dates[0] or False
+
+
+def bench(function, files, repeat):
+    '''Menor tempo entre as repetições e os resultados.'''
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        results = [function(filepath) for filepath in files]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, results
+
+
+def main(folder, repeat=3):
+    files = corpus(folder)
+    if not files:
+        print 'Nenhuma imagem em %s' % folder
+        return 1
+    print '%d imagens, melhor de %d repetições' % (len(files), repeat)
+    elapsed, ours = bench(with_iptcinfo, files, repeat)
+    print 'iptcinfo.readExif: %.3f s (%.2f ms/imagem)' % (
+            elapsed, elapsed * 1000 / len(files))
+    if pyexiv2 is None:
+        print 'pyexiv2 não está instalado, sem comparação.'
+        return 0
+    elapsed_exiv2, theirs = bench(with_pyexiv2, files, repeat)
+    print 'pyexiv2:           %.3f s (%.2f ms/imagem)' % (
+            elapsed_exiv2, elapsed_exiv2 * 1000 / len(files))
+    print '%.1fx mais rápido' % (elapsed_exiv2 / elapsed)
+    differ = [filepath for filepath, a, b in zip(files, ours, theirs) if a != b]
+    for filepath in differ:
+        print 'DIFERENTE:', filepath
+    return len(differ) and 1 or 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(2)
+    sys.exit(main(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]]))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Fuzzing do leitor de cabeçalhos do iptcinfo.
+
+Uso: python benchmarks/fuzz.py [casos] [semente]
+
+Gera imagens do corpus sintético (veja corpus.py) e estraga o cabeçalho
+delas: troca bytes, corta o arquivo, muda tamanhos de segmentos e insere
+marcadores. Cada imagem estragada é lida de quatro jeitos (leitura
+completa, só cabeçalho com EXIF e tamanho, da memória e só EXIF). Exceções
+são esperadas; falha é demorar mais que LIMITE segundos, ficar sem
+memória ou, na leitura só do cabeçalho, ler mais bytes que o arquivo tem.
+Retorna 1 se algum caso falhou.
+'''
+
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from struct import pack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from iptcinfo import IPTCInfo, readExif
+
+import corpus
+
+# Segundos que uma leitura pode levar
+LIMITE = 0.5
+
+
+class Timeout(BaseException):
+    '''Leitura interrompida pelo alarme.'''
+
+
+def alarm(signum, frame):
+    raise Timeout()
+
+
+def segments(data):
+    '''Posições dos marcadores do cabeçalho, até o SOS.'''
+    positions = []
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == '\xff':
+        positions.append(pos)
+        if data[pos + 1] == '\xda':
+            break
+        pos += 2 + (ord(data[pos + 2]) << 8 | ord(data[pos + 3]))
+    return positions
+
+
+def mutate(rnd, data):
+    '''Estraga o cabeçalho da imagem de um jeito sorteado.'''
+    data = bytearray(data)
+    marks = segments(str(data))
+    header = marks and marks[-1] + 4 or 512
+    kind = rnd.choice(('bytes', 'truncate', 'length', 'marker'))
+    if kind == 'bytes':
+        for i in xrange(rnd.randint(1, 8)):
+            data[rnd.randrange(header)] = rnd.randrange(256)
+    elif kind == 'truncate':
+        del data[rnd.randrange(2, header):]
+    elif kind == 'length' and marks:
+        pos = rnd.choice(marks)
+        size = rnd.choice((0, 1, 2, 3, 0xffff, rnd.randrange(0x10000)))
+        data[pos + 2:pos + 4] = pack('!H', size)
+    else:
+        pos = rnd.randrange(2, header)
+        data[pos:pos] = '\xff' * rnd.randint(1, 4) + chr(rnd.choice(
+                (0xd8, 0xd9, 0xda, 0xe1, 0xed, 0xc0, 0x00, 0xff)))
+    return kind, str(data)
+
+
+def full(filepath, data):
+    IPTCInfo(filepath, force=True).data.items()
+
+
+def header(filepath, data):
+    info = IPTCInfo(filepath, force=True, readonly=True, exif=True,
+            imageinfo=True)
+    info.data.items()
+    if info.bytesRead > len(data):
+        return 'leu %d bytes de %d' % (info.bytesRead, len(data))
+
+
+def memory(filepath, data):
+    IPTCInfo.fromBuffer(data, force=True, exif=True,
+            imageinfo=True).data.items()
+
+
+def exif(filepath, data):
+    readExif(filepath)
+
+
+READERS = [full, header, memory, exif]
+
+
+def check(reader, filepath, data):
+    '''Roda o leitor; retorna (tempo, falha ou None, exceção ou None).'''
+    signal.setitimer(signal.ITIMER_REAL, 5 * LIMITE, 5 * LIMITE)
+    start = time.time()
+    error = problem = None
+    try:
+        try:
+            problem = reader(filepath, data)
+        except Timeout:
+            problem = 'não terminou'
+        except MemoryError:
+            problem = 'sem memória'
+        except Exception, e:
+            error = e.__class__.__name__
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    took = time.time() - start
+    if problem is None and took > LIMITE:
+        problem = 'demorou %.2f s' % took
+    return took, problem, error
+
+
+def main(cases=500, seed=1):
+    signal.signal(signal.SIGALRM, alarm)
+    rnd = random.Random(seed)
+    folder = tempfile.mkdtemp(prefix='iptcinfo-fuzz')
+    filepath = os.path.join(folder, 'fuzz.jpg')
+    failures = 0
+    slowest = dict([(reader.__name__, 0.0) for reader in READERS])
+    errors = {}
+    # O que o iptcinfo imprime vai para stderr, sem poluir o relatório
+    stdout = sys.stdout
+    try:
+        bases = [corpus.jpeg(rnd, **dict(corpus.variants(rnd), body=20000))
+                for i in xrange(20)]
+        for n in xrange(cases):
+            kind, data = mutate(rnd, rnd.choice(bases))
+            out = open(filepath, 'wb')
+            out.write(data)
+            out.close()
+            for reader in READERS:
+                sys.stdout = sys.stderr
+                try:
+                    took, problem, error = check(reader, filepath, data)
+                finally:
+                    sys.stdout = stdout
+                name = reader.__name__
+                slowest[name] = max(slowest[name], took)
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+                if problem:
+                    failures += 1
+                    failed = os.path.join(folder, 'falha%04d.jpg' % n)
+                    shutil.copy(filepath, failed)
+                    print 'FALHA %d (%s) %s: %s, salvo em %s' % (n, kind, name,
+                            problem, failed)
+    finally:
+        sys.stdout = stdout
+    print '%d casos, %d falhas' % (cases, failures)
+    for name in sorted(slowest):
+        print 'mais lenta %-8s %.4f s' % (name + ':', slowest[name])
+    for name, count in sorted(errors.items()):
+        print 'exceção %s: %d' % (name, count)
+    if not failures:
+        shutil.rmtree(folder)
+    return failures and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
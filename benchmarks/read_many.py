@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compara a leitura em lote do IPTC: laço serial x iptcinfo.read_many.
+
+Uso: python benchmarks/read_many.py pasta_com_fotos [workers]
+
+Lê todas as imagens JPEG da pasta (recursivamente) com um laço de
+IPTCInfo, com read_many em threads e com read_many em processos, confere
+se os registros batem e mostra o tempo de cada um.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from iptcinfo import IPTCInfo, read_many
+
+
+def corpus(folder):
+    '''Lista as imagens JPEG da pasta.'''
+    files = []
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                files.append(os.path.join(root, name))
+    return files
+
+
+def serial(files):
+    '''Um IPTCInfo por vez, como era feito.'''
+    results = []
+    for filepath in files:
+        try:
+            data = IPTCInfo(filepath, readonly=True).data
+            record = dict([(data.keyAsStr(k), v) for (k, v) in data.iteritems()])
+        except Exception, e:
+            record = e
+        results.append((filepath, record))
+    return results
+
+
+def same(a, b):
+    '''Compara resultados; exceções valem pela mensagem.'''
+    return [(path, str(record)) for path, record in a] == \
+            [(path, str(record)) for path, record in b]
+
+
+def main(folder, workers=4):
+    files = corpus(folder)
+    if not files:
+        print 'Nenhuma imagem em %s' % folder
+        return 1
+    print '%d imagens, %d workers' % (len(files), workers)
+    start = time.time()
+    reference = serial(files)
+    elapsed = time.time() - start
+    print 'serial:              %.3f s' % elapsed
+    status = 0
+    for label, processes in (('threads', False), ('processos', True)):
+        start = time.time()
+        results = list(read_many(files, workers=workers, processes=processes))
+        took = time.time() - start
+        print 'read_many %-10s %.3f s (%.1fx)' % (label + ':', took,
+                elapsed / took)
+        if not same(results, reference):
+            print 'DIFERENTE do serial!'
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(2)
+    sys.exit(main(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]]))
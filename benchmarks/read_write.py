@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Mede leitura e gravação do iptcinfo num corpus sintético.
+
+Uso: python benchmarks/read_write.py [pasta] [quantidade]
+
+Gera o corpus (veja corpus.py) na pasta, ou numa pasta temporária, e
+roda cada operação sobre todas as imagens num processo separado. Mostra
+imagens/s, MB/s (pelo tamanho dos arquivos) e o pico de memória de cada
+operação, descontada a memória do processo antes de começar.
+'''
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from iptcinfo import IPTCInfo, readExif
+
+import corpus
+
+
+def read(filepath, workdir):
+    '''Leitura completa, como o Véliger fazia.'''
+    IPTCInfo(filepath, force=True).data.items()
+
+
+def readonly(filepath, workdir):
+    '''Só o cabeçalho, sem buffer.'''
+    IPTCInfo(filepath, force=True, readonly=True).data.items()
+
+
+def readall(filepath, workdir):
+    '''IPTC, EXIF e tamanho da imagem numa passada.'''
+    info = IPTCInfo(filepath, force=True, readonly=True, exif=True,
+            imageinfo=True)
+    info.data.items()
+
+
+def exif(filepath, workdir):
+    '''Só as datas e o GPS do EXIF.'''
+    readExif(filepath)
+
+
+def frombuffer(filepath, workdir):
+    '''Imagem inteira na memória.'''
+    IPTCInfo.fromBuffer(open(filepath, 'rb').read(), force=True).data.items()
+
+
+def saveas(filepath, workdir):
+    '''Grava uma cópia com uma palavra-chave a mais.'''
+    info = IPTCInfo(filepath, force=True)
+    info.keywords.append('benchmark')
+    info.saveAs(os.path.join(workdir, os.path.basename(filepath)),
+            {'backup': 'off'})
+
+
+def save(filepath, workdir):
+    '''Grava na própria imagem (na cópia da pasta de trabalho).'''
+    info = IPTCInfo(os.path.join(workdir, os.path.basename(filepath)),
+            force=True)
+    info.data['city'] = u'Ubatuba'
+    info.save({'backup': 'off'})
+
+
+OPERATIONS = [read, readonly, readall, exif, frombuffer, saveas, save]
+
+
+def run(operation, paths, workdir, results):
+    '''Roda a operação em todas as imagens e devolve tempo e memória.'''
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    errors = 0
+    start = time.time()
+    for filepath in paths:
+        try:
+            operation(filepath, workdir)
+        except Exception:
+            errors += 1
+    took = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    results.put((took, peak, errors))
+
+
+def measure(operation, paths, workdir):
+    '''Roda a operação num processo novo, para medir o pico de memória.'''
+    results = Queue()
+    process = Process(target=run, args=(operation, paths, workdir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(folder=None, count=200):
+    temporary = folder is None
+    if temporary:
+        folder = tempfile.mkdtemp(prefix='iptcinfo-corpus')
+    workdir = tempfile.mkdtemp(prefix='iptcinfo-work')
+    try:
+        paths = corpus.generate(folder, count)
+        megabytes = sum([os.path.getsize(p) for p in paths]) / 1048576.0
+        print '%d imagens, %.1f MB em %s' % (len(paths), megabytes, folder)
+        print '%-12s %10s %10s %10s %8s' % ('operação', 'imagens/s', 'MB/s',
+                'pico KB', 'erros')
+        for operation in OPERATIONS:
+            took, peak, errors = measure(operation, paths, workdir)
+            print '%-12s %10.1f %10.1f %10d %8d' % (operation.__name__,
+                    len(paths) / took, megabytes / took, peak, errors)
+    finally:
+        shutil.rmtree(workdir)
+        if temporary:
+            shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:3]
+    if args and not args[0].isdigit():
+        folder = args.pop(0)
+    else:
+        folder = None
+    sys.exit(main(folder, *[int(arg) for arg in args]))
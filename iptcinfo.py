@@ -110,6 +110,43 @@ DESCRIPTION
     ('supplemental categories', 'keywords', 'contacts') will be empty
     lists.
 
+    IMAGES IN MEMORY
+
+    An image already in memory is parsed where it is, without file-like
+    wrappers, and can be saved into another buffer:
+
+        info = IPTCInfo.fromBuffer(data)      # str, bytearray, mmap...
+        info.data['city'] = 'Ubatuba'
+        out = bytearray(len(data) + 4096)
+        length = info.saveInto(out)
+
+    READING EXIF DATES AND GPS
+
+    Pass exif=True to also read the date and GPS tags of the EXIF block
+    while the file is scanned for IPTC data:
+
+        info = IPTCInfo('file-name-here.jpg', exif=True)
+        print info.exif.get('Exif.Photo.DateTimeOriginal')
+        print info.exif.get('Exif.GPSInfo.GPSLatitude')
+
+    The same tags can be changed, and are then written by the next save
+    together with the IPTC data, so the file is rewritten only once:
+
+        info.setExif('Exif.GPSInfo.GPSLatitude', [23, 49, 30])
+        info.delExif('Exif.GPSInfo.GPSAltitude')
+        info.save()
+
+    IMAGE SIZE AND ORIENTATION
+
+    Pass imageinfo=True to get the pixel size and layout of the image
+    from its start of frame marker, and the EXIF orientation, in the
+    same scan, without decoding the image:
+
+        info = IPTCInfo('file-name-here.jpg', imageinfo=True)
+        print info.imageInfo
+        # {'width': 640, 'height': 480, 'components': 3, 'precision': 8,
+        #  'progressive': False, 'orientation': 1}
+
     MODIFYING IPTC DATA
 
     You can modify IPTC data in JPEG files and save the file back to
@@ -159,6 +196,39 @@ DESCRIPTION
     yourself, the new image will have an Adobe part with only the IPTC
     information.
 
+    If the file already has exactly the IIM data to be written (say, a
+    template applied twice) and no EXIF tag changes, save() does not
+    touch it and returns SKIPPED instead of True.
+
+    Unless written in place (see below), a saved file is built in a
+    temporary file in the same directory and then renamed over the
+    original, so a failed save never leaves a half written image behind.
+    No copy of the old file is kept by default (SAVE_BACKUP is 'off');
+    pass {'backup': 'hardlink'} to keep it as 'file~' (a hard link to it,
+    so no copy is made), or {'backup': 'reflink'} to keep an independent
+    copy-on-write clone on filesystems that support it (btrfs, xfs).
+
+    With 'off' (the default) or 'reflink' (once the clone is made),
+    saving back to the same file overwrites the APP13 block in place if
+    the new data fits in it, leaving the rest of the file untouched, so
+    a caption edit writes a few KB instead of the whole image. That
+    write is not atomic: with 'off' a crash in the middle of it can leave
+    the block corrupt. A hard link shares the data being overwritten, so
+    with 'hardlink' the file is always rewritten. A rewritten file gets
+    APP13_RESERVE bytes of padding in the block, so later edits fit in
+    place. Pass {'reserve': bytes} to change the
+    padding, or {'forceRewrite': 'on'} to always rewrite the whole file.
+
+    READING MANY FILES
+
+    read_many reads a batch of files with a thread (or process) pool and
+    yields (path, record or exception) tuples:
+
+        for (path, record) in read_many(paths, workers=8,
+                                        fields=['keywords', 'by-line']):
+            if isinstance(record, Exception): print path, record
+            else: print path, record['keywords']
+
     XML AND SQL EXPORT FEATURES
 
     IPTCInfo also allows you to easily generate XML and SQL from the image
@@ -193,6 +263,23 @@ DESCRIPTION
     table. As with XML export, you can also provide extra information to
     be stuck into the SQL.
 
+    For a catalog of many files, export_records writes one XML element or
+    one line of JSON per file to a file handle as the files are read, so
+    memory use does not grow with the number of files:
+
+        out = file('catalog.jsonl', 'wb')
+        export_records(read_many(paths), out, format='jsonl')
+
+    To load a whole archive into a SQLite database, use export_sqlite,
+    which reads the files with read_many and inserts their rows in
+    batches, with parameters (no quoting of values by hand):
+
+        (rows, failed) = export_sqlite(paths, 'archive.db', table='photos')
+
+    The table gets a path primary key and a text column per dataset of
+    c_datasets (see sqlColumnName); a file already in it has its row
+    replaced.
+
 IPTC ATTRIBUTE REFERENCE
 
     object name               originating program
@@ -243,9 +330,24 @@ __author__ = u'Gulácsi, Tamás'
 
 SURELY_WRITE_CHARSET_INFO = False
 
-from struct import pack, unpack
+# Bytes of padding reserved in the APP13 block when the file is rewritten,
+# so later edits can be written in place (see IPTCInfo.saveAs).
+APP13_RESERVE = 1024
+
+# What saveAs keeps of the old file as "file~": 'off', 'hardlink' or
+# 'reflink' (falls back to a hardlink where the filesystem can't clone).
+# 'hardlink' can't protect an in-place write, so it turns that path off.
+SAVE_BACKUP = 'off'
+
+# Returned by IPTCInfo.save instead of True when the file already has the
+# IPTC data (and EXIF tags) to be written, and was left untouched.
+SKIPPED = 'skipped'
+
+from struct import pack, unpack, unpack_from, Struct
 from cStringIO import StringIO
-import sys, re, codecs, os, tempfile, shutil
+import sys, re, codecs, os, tempfile, shutil, mmap
+from fractions import Fraction
+from datetime import datetime
 
 class String(basestring):
     def __iadd__(self, other):
@@ -265,6 +367,158 @@ def push(diction, key, value):
         diction[key].append(value)
     else: diction[key] = value
 
+# ioctl number of FICLONE (linux/fs.h), used for reflink backups
+FICLONE = 0x40049409
+
+# Kernel copies found by kernelCopiers, None until first used
+_kernelCopiers = None
+
+def kernelCopiers():
+    """Functions (infd, outfd, offset, count) -> bytes copied that copy
+    between file descriptors inside the kernel: libc's copy_file_range
+    (which can share the blocks on btrfs or xfs) and sendfile64, called
+    through ctypes since os.sendfile is Python 3 only. Empty where they
+    can't be loaded (not Linux, an old libc)."""
+    global _kernelCopiers
+    if _kernelCopiers is not None: return _kernelCopiers
+    _kernelCopiers = []
+    if not sys.platform.startswith('linux'): return _kernelCopiers
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError), e:
+        debug(2, 'no libc: %s' % e)
+        return _kernelCopiers
+    offp = ctypes.POINTER(ctypes.c_longlong)
+
+    def checked(n):
+        if n < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return n
+
+    copy_file_range = getattr(libc, 'copy_file_range', None)
+    if copy_file_range is not None:
+        copy_file_range.argtypes = [ctypes.c_int, offp, ctypes.c_int,
+                                    offp, ctypes.c_size_t, ctypes.c_uint]
+        copy_file_range.restype = ctypes.c_ssize_t
+        def copyRange(infd, outfd, offset, count):
+            # the output offset is NULL: write at outfd's position
+            return checked(copy_file_range(infd, ctypes.byref(
+                ctypes.c_longlong(offset)), outfd, None, count, 0))
+        _kernelCopiers.append(copyRange)
+    sendfile64 = getattr(libc, 'sendfile64', None)
+    if sendfile64 is not None:
+        sendfile64.argtypes = [ctypes.c_int, ctypes.c_int, offp,
+                               ctypes.c_size_t]
+        sendfile64.restype = ctypes.c_ssize_t
+        def sendFile(infd, outfd, offset, count):
+            return checked(sendfile64(outfd, infd, ctypes.byref(
+                ctypes.c_longlong(offset)), count))
+        _kernelCopiers.append(sendFile)
+    return _kernelCopiers
+
+def copyFileRange(src, dst, offset, bufsize=1048576):
+    """Copies everything in file src from offset on to the current
+    position of file dst, without holding it all in memory. Between real
+    files on Linux the data is copied inside the kernel (see
+    kernelCopiers), never passing through Python; otherwise, or if the
+    kernel refuses these files, it is streamed in reads and writes of
+    bufsize bytes."""
+    dst.flush()
+    if duck_typed(src, 'fileno') and duck_typed(dst, 'fileno'):
+        (infd, outfd) = (src.fileno(), dst.fileno())
+        for copier in kernelCopiers():
+            try:
+                while 1:
+                    copied = copier(infd, outfd, offset, bufsize)
+                    if copied == 0: return
+                    offset += copied
+            except OSError, e:
+                # not supported between these files, try the next way
+                debug(2, 'kernel copy failed: %s' % e)
+        dst.seek(0, 2)
+    src.seek(offset, 0)
+    while 1:
+        buf = src.read(bufsize)
+        if not buf: break
+        dst.write(buf)
+
+def asBuffer(data):
+    """A read-only view of str, bytearray, mmap or memoryview data that
+    indexes to one character strings, without copying it."""
+    if isinstance(data, memoryview): return data
+    return buffer(data)
+
+def copyBufferRange(src, offset, dst, at, bufsize=1048576):
+    """Copies src[offset:] (see asBuffer) into the writable buffer dst at
+    position at. bytearray and memoryview destinations get it in one
+    slice assignment from a view of src; mmap slices only take strings,
+    so those are copied bufsize bytes at a time."""
+    length = len(src) - offset
+    if isinstance(dst, mmap.mmap):
+        for n in xrange(0, length, bufsize):
+            data = src[offset+n:offset+min(n+bufsize, length)]
+            if isinstance(data, memoryview): data = data.tobytes()
+            dst[at+n:at+n+len(data)] = data
+    elif isinstance(src, memoryview):
+        dst[at:at+length] = src[offset:]
+    else:
+        dst[at:at+length] = buffer(src, offset)
+
+def replaceFile(src, dst):
+    """Renames src to dst, replacing dst atomically where the OS can."""
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        return replace(src, dst)
+    if os.name == 'nt' and os.path.exists(dst):
+        # rename does not overwrite on Windows
+        os.unlink(dst)
+    os.rename(src, dst)
+
+def reflinkFile(src, dst):
+    """Clones src as dst (copy-on-write, no data copied). Returns False,
+    leaving no dst behind, where the filesystem can't clone."""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        import fcntl
+        sfh = open(src, 'rb')
+        try:
+            dfh = open(dst, 'wb')
+            try:
+                fcntl.ioctl(dfh.fileno(), FICLONE, sfh.fileno())
+            finally:
+                dfh.close()
+        finally:
+            sfh.close()
+        shutil.copystat(src, dst)
+        return True
+    except (ImportError, IOError, OSError), e:
+        debug(2, 'reflink failed: %s' % e)
+        if os.path.exists(dst):
+            os.unlink(dst)
+        return False
+
+def backupFile(src, dst, how='hardlink'):
+    """Keeps the current contents of src as dst, without copying the data:
+    'hardlink' links dst to src, 'reflink' clones it (copy-on-write) where
+    the filesystem supports it and links it otherwise, 'off' does
+    nothing."""
+    if how == 'off' or not how:
+        return
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if how == 'reflink':
+        if reflinkFile(src, dst):
+            return
+    elif how != 'hardlink':
+        raise ValueError('unknown backup mode: %r' % (how,))
+    if hasattr(os, 'link'):
+        os.link(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
 def duck_typed(obj, prefs):
     if isinstance(prefs, basestring): prefs = [prefs]
     for pref in prefs:
@@ -354,19 +608,78 @@ c_datasets = {
 c_datasets_r = dict([(v, k) for k, v in c_datasets.iteritems()])
 del k, v
 
+class IIMRaw(object):
+    """The values of one IIM dataset as read from the file, not decoded
+    yet: (buffer, offset, length) spans over the data they are in, and
+    the character set to decode them with. After decode() the decoded
+    value is kept in value (a tuple for list datasets)."""
+    __slots__ = ('spans', 'charset', 'islist', 'value')
+
+    def __init__(self, charset, islist):
+        self.spans = []
+        self.charset = charset
+        self.islist = islist
+        self.value = None
+
+    def chunks(self):
+        """The raw values; only the last one for a single valued dataset."""
+        spans = (self.islist and [self.spans] or [self.spans[-1:]])[0]
+        return [buf[offset:offset+length] for (buf, offset, length) in spans]
+
+    def decode(self):
+        values = [decodeIIM(v, self.charset) for v in self.chunks()]
+        if self.islist:
+            self.value = tuple(values)
+            return values
+        self.value = values[0]
+        return self.value
+
+def decodeIIM(value, charset):
+    try: return unicode(value, encoding=charset, errors='strict')
+    except:
+        debug(1, 'Data "%s" is not in encoding %s!' % (value, charset))
+        return unicode(value, encoding=charset, errors='replace')
+
+# Encoded values by (type, value, input charset, output charset), so the
+# same keywords written to many files are encoded only once.
+c_encode_cache = {}
+c_encode_cache_size = 4096
+
+def encodeIIM(text, inp_charset, out_charset):
+    """Returns text (unicode, or str in inp_charset) as str in out_charset."""
+    key = (type(text), text, inp_charset, out_charset)
+    try: return c_encode_cache[key]
+    except KeyError: pass
+    if isinstance(text, unicode): res = text.encode(out_charset)
+    else:
+        try: res = unicode(text, encoding=inp_charset).encode(out_charset)
+        except:
+            debug(1, "encodeIIM: charset %s is not working for %s"
+                  % (inp_charset, text))
+            res = unicode(text, encoding=inp_charset, errors='replace'
+                          ).encode(out_charset)
+    if len(c_encode_cache) >= c_encode_cache_size: c_encode_cache.clear()
+    c_encode_cache[key] = res
+    return res
+
 class IPTCData(dict):
-    """Dict with int/string keys from c_listdatanames"""
+    """Dict with int/string keys from c_listdatanames
+
+    Values read from a file are kept as IIMRaw until they are first
+    accessed, so only the datasets that are used get decoded, and
+    the ones left unchanged can be written back as they were."""
     def __init__(self, diction={}, *args, **kwds):
         super(type(self), self).__init__(self, *args, **kwds)
+        self._raw = {}
         self.update(dict([(self.keyAsInt(k), v)
                                             for k, v in diction.iteritems()]))
 
     c_cust_pre = 'nonstandard_'
     def keyAsInt(self, key):
-        global c_datasets_r
         if isinstance(key, int): return key #and c_datasets.has_key(key): return key
-        elif c_datasets_r.has_key(key): return c_datasets_r[key]
-        elif (key.startswith(self.c_cust_pre)
+        try: return c_datasets_r[key]
+        except KeyError: pass
+        if (key.startswith(self.c_cust_pre)
                     and key[len(self.c_cust_pre):].isdigit()):
             return int(key[len(self.c_cust_pre):])
         else: raise KeyError("Key %s is not in %s!" % (key, c_datasets_r.keys()))
@@ -378,17 +691,65 @@ class IPTCData(dict):
         elif isinstance(key, int): return self.c_cust_pre + str(key)
         else: raise KeyError("Key %s is not in %s!" % (key, c_datasets.keys()))
 
+    def _decoded(self, key, value):
+        if isinstance(value, IIMRaw):
+            value = value.decode()
+            dict.__setitem__(self, key, value)
+        return value
+
     def __getitem__(self, name):
-        return super(type(self), self).get(self.keyAsInt(name), None)
+        key = self.keyAsInt(name)
+        return self._decoded(key, dict.get(self, key, None))
+
+    def get(self, name, default=None):
+        key = self.keyAsInt(name)
+        if not dict.has_key(self, key): return default
+        return self._decoded(key, dict.__getitem__(self, key))
+
+    def iteritems(self):
+        for (key, value) in dict.items(self):
+            yield (key, self._decoded(key, value))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for (key, value) in self.iteritems(): yield value
+
+    def values(self):
+        return list(self.itervalues())
 
     def __setitem__(self, name, value):
         key = self.keyAsInt(name)
-        o = super(type(self), self)
-        if o.has_key(key) and isinstance(o.__getitem__(key), list):
-            #print key, c_datasets[key], o.__getitem__(key)
-            if isinstance(value, list): o.__setitem__(key, value)
+        old = dict.get(self, key, None)
+        if isinstance(old, list) or (isinstance(old, IIMRaw) and old.islist):
+            #print key, c_datasets[key], old
+            if isinstance(value, list): dict.__setitem__(self, key, value)
             else: raise ValueError("For %s only lists acceptable!" % name)
-        else: o.__setitem__(self.keyAsInt(name), value)
+        else: dict.__setitem__(self, key, value)
+
+    def addRaw(self, key, buf, offset, length, charset):
+        """Adds a value read from the file, as length bytes at offset in
+        buf; it is decoded from charset when first accessed."""
+        raw = dict.get(self, key, None)
+        if not isinstance(raw, IIMRaw) or raw is not self._raw.get(key):
+            raw = IIMRaw(charset, isinstance(raw, list))
+            self._raw[key] = raw
+            dict.__setitem__(self, key, raw)
+        raw.spans.append((buf, offset, length))
+
+    def unchanged(self, key):
+        """The raw values of dataset key if it still has the value read
+        from the file, else None."""
+        raw = self._raw.get(key, None)
+        if raw is None: return None
+        value = dict.get(self, key, None)
+        if value is raw: return raw.chunks()
+        if raw.islist:
+            if isinstance(value, list) and tuple(value) == raw.value:
+                return raw.chunks()
+        elif value is raw.value: return raw.chunks()
+        return None
 
 def debug(level, *args):
     if level < debugMode:
@@ -410,6 +771,455 @@ def _getSetSomeList(name):
     return (getList, setList)
 
 
+class JpegMarkerScanner(object):
+    """Walks the marker segments of a Jpeg file with buffered reads.
+
+    The header region is read CHUNK bytes at a time and markers are
+    located with str.find on the buffer, instead of one read() per byte.
+    Segments nobody asked for are skipped with a seek once they run past
+    the buffer, so large APP1/ICC blocks are never read at all.
+
+    The file position is left undefined; use tell() for the logical
+    position inside the file.
+
+    If bounded==True (for unbuffered files, where each read is a system
+    call), the first CHUNK bytes are taken in one read and parsed from
+    memory; most headers end inside them. A segment running past them is
+    read in a second call together with the next CHUNK bytes, so the
+    markers after it need no more reads. Small segments past the buffer
+    are read through instead of seeked over."""
+
+    CHUNK = 65536
+    SMALL_SKIP = 4096
+
+    def __init__(self, fh, chunk=None, bounded=False):
+        assert duck_typed(fh, ['read', 'seek', 'tell'])
+        self.fh = fh
+        self.chunk = chunk or self.CHUNK
+        self.bounded = bounded
+        self.base = fh.tell()   # file offset of buf[0]
+        self.buf = ''
+        self.pos = 0
+        self.bytesRead = 0
+        self.reads = 0
+
+    def tell(self):
+        return self.base + self.pos
+
+    def _fill(self, need):
+        """Makes sure need bytes are buffered past pos. False on EOF."""
+        if len(self.buf) - self.pos >= need: return True
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.base += self.pos
+            self.pos = 0
+        while len(self.buf) < need:
+            if self.bounded and self.reads:
+                # the header goes on past what was read: the rest of this
+                # segment and a chunk for the markers after it
+                size = need - len(self.buf) + self.chunk
+            else: size = max(self.chunk, need - len(self.buf))
+            data = self.fh.read(size)
+            self.reads += 1
+            if not data: return False
+            self.bytesRead += len(data)
+            self.buf += data
+        return True
+
+    def read(self, length):
+        """Returns exactly length bytes, raising EOFException otherwise."""
+        if not self._fill(length):
+            self.pos = len(self.buf)
+            raise EOFException('JpegMarkerScanner.read: %s' % str(self.fh))
+        data = self.buf[self.pos:self.pos+length]
+        self.pos += length
+        return data
+
+    def peek(self, length):
+        """Returns up to length bytes without consuming them."""
+        self._fill(length)
+        return self.buf[self.pos:self.pos+length]
+
+    def skip(self, length):
+        """Skips length bytes, seeking when they are not buffered."""
+        if self.pos + length <= len(self.buf):
+            self.pos += length
+        elif self.bounded and length <= self.SMALL_SKIP:
+            self._fill(length)
+            self.pos = min(self.pos + length, len(self.buf))
+        else:
+            self.base += self.pos + length
+            self.buf = ''
+            self.pos = 0
+            self.fh.seek(self.base, 0)
+
+    def nextMarker(self):
+        """Scans to the start of the next valid-looking marker. Returns
+        the marker id as an int, or None on EOF."""
+        # Find 0xff byte. We should already be on it.
+        while 1:
+            if not self._fill(1): return None
+            idx = self.buf.find('\xff', self.pos)
+            if idx != self.pos:
+                debug(1, "JpegMarkerScanner: warning: bogus stuff in Jpeg file")
+            if idx >= 0: break
+            self.pos = len(self.buf)
+        self.pos = idx + 1
+        # Now skip any extra 0xffs, which are valid padding.
+        while 1:
+            if not self._fill(1): return None
+            if self.buf[self.pos] != '\xff': break
+            self.pos += 1
+        marker = ord(self.buf[self.pos])
+        self.pos += 1
+        return marker
+
+    def variableLength(self):
+        """Gets length of current variable-length section, which must be
+        just past the marker. Returns 0 on EOF or an erroneous length."""
+        try: length = unpack('!H', self.read(2))[0]
+        except EOFException: return 0
+        if length < 2: return 0
+        return length - 2
+
+
+class BufferScanner(JpegMarkerScanner):
+    """JpegMarkerScanner over a Jpeg already in memory: a str, bytearray,
+    mmap, buffer or memoryview. Positions are plain offsets, skipping is
+    offset arithmetic and lengths are read with unpack_from, so nothing
+    is copied but the segments asked for with read() or peek()."""
+
+    def __init__(self, data):
+        self.fh = None
+        self.bounded = False
+        self.buf = asBuffer(data)
+        self.base = self.pos = 0
+        self.bytesRead = self.reads = 0
+
+    def _fill(self, need):
+        return len(self.buf) - self.pos >= need
+
+    def _slice(self, start, stop):
+        data = self.buf[start:stop]
+        if isinstance(data, memoryview): return data.tobytes()
+        return data
+
+    def read(self, length):
+        if not self._fill(length):
+            self.pos = len(self.buf)
+            raise EOFException('BufferScanner.read: past end of buffer')
+        self.pos += length
+        return self._slice(self.pos - length, self.pos)
+
+    def peek(self, length):
+        return self._slice(self.pos, self.pos + length)
+
+    def skip(self, length):
+        self.pos = min(self.pos + length, len(self.buf))
+
+    def nextMarker(self):
+        (buf, pos, end) = (self.buf, self.pos, len(self.buf))
+        if pos < end and buf[pos] != '\xff':
+            debug(1, "BufferScanner: warning: bogus stuff in Jpeg file")
+        while pos < end and buf[pos] != '\xff': pos += 1
+        while pos < end and buf[pos] == '\xff': pos += 1
+        if pos >= end:
+            self.pos = end
+            return None
+        self.pos = pos + 1
+        return ord(buf[pos])
+
+    def variableLength(self):
+        if not self._fill(2):
+            self.pos = len(self.buf)
+            return 0
+        length = unpack_from('!H', self.buf, self.pos)[0]
+        self.pos += 2
+        if length < 2: return 0
+        return length - 2
+
+
+#######################################################################
+# EXIF (APP1) reading
+#######################################################################
+
+# The EXIF tags IPTCInfo decodes, by IFD and tag number, with the names
+# exiv2 gives them.
+c_exif_tags = {
+    ('Image', 0x0112): 'Exif.Image.Orientation',
+    ('Image', 0x0132): 'Exif.Image.DateTime',
+    ('Photo', 0x9003): 'Exif.Photo.DateTimeOriginal',
+    ('Photo', 0x9004): 'Exif.Photo.DateTimeDigitized',
+    ('GPSInfo', 0): 'Exif.GPSInfo.GPSVersionID',
+    ('GPSInfo', 1): 'Exif.GPSInfo.GPSLatitudeRef',
+    ('GPSInfo', 2): 'Exif.GPSInfo.GPSLatitude',
+    ('GPSInfo', 3): 'Exif.GPSInfo.GPSLongitudeRef',
+    ('GPSInfo', 4): 'Exif.GPSInfo.GPSLongitude',
+    ('GPSInfo', 5): 'Exif.GPSInfo.GPSAltitudeRef',
+    ('GPSInfo', 6): 'Exif.GPSInfo.GPSAltitude',
+    ('GPSInfo', 7): 'Exif.GPSInfo.GPSTimeStamp',
+    ('GPSInfo', 18): 'Exif.GPSInfo.GPSMapDatum',
+    ('GPSInfo', 29): 'Exif.GPSInfo.GPSDateStamp',
+    }
+c_exif_tags_r = dict([(v, k) for k, v in c_exif_tags.iteritems()])
+# pointers from IFD0 to the sub-IFDs
+c_exif_ifds = {0x8769: 'Photo', 0x8825: 'GPSInfo'}
+c_exif_ifds_r = dict([(v, k) for k, v in c_exif_ifds.iteritems()])
+# TIFF type and count written for the tags that are not ASCII text
+c_exif_formats = {'Exif.Image.Orientation': (3, 1),
+                  'Exif.GPSInfo.GPSVersionID': (1, 4),
+                  'Exif.GPSInfo.GPSLatitude': (5, 3),
+                  'Exif.GPSInfo.GPSLongitude': (5, 3),
+                  'Exif.GPSInfo.GPSAltitudeRef': (1, 1),
+                  'Exif.GPSInfo.GPSAltitude': (5, 1),
+                  'Exif.GPSInfo.GPSTimeStamp': (5, 3)}
+# the tags gpsInfo needs, and the dates, most relevant first
+c_exif_gps = ('Exif.GPSInfo.GPSLatitudeRef', 'Exif.GPSInfo.GPSLatitude',
+              'Exif.GPSInfo.GPSLongitudeRef', 'Exif.GPSInfo.GPSLongitude')
+c_exif_dates = ('Exif.Photo.DateTimeOriginal', 'Exif.Photo.DateTimeDigitized',
+                'Exif.Image.DateTime')
+# TIFF field types: size and struct format of one value
+c_exif_types = {1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'L'),
+                5: (8, 'LL'), 7: (1, 's'), 9: (4, 'l'), 10: (8, 'll')}
+
+def readExifTags(tiff, tags=None):
+    """Decodes the date and GPS tags (c_exif_tags) of the TIFF structure
+    in an APP1 Exif segment (the bytes after 'Exif\\0\\0'). Returns a dict
+    keyed by the exiv2 tag names: rationals come as Fractions, dates as
+    datetimes and text as str. Tags that can't be read are left out.
+
+    If tags is given, only those tags are decoded, and a sub-IFD is only
+    visited when one of them is in it."""
+    exif = {}
+    if tags is None: wanted = None
+    else:
+        wanted = dict([(c_exif_tags_r[name], name) for name in tags
+                       if c_exif_tags_r.has_key(name)])
+        if not wanted: return exif
+        subifds = dict([(k[0], True) for k in wanted.keys()])
+    if tiff[:4] == 'II*\x00': bo = '<'
+    elif tiff[:4] == 'MM\x00*': bo = '>'
+    else: return exif
+    try: ifds = [('Image', unpack(bo + 'L', tiff[4:8])[0])]
+    except Exception: return exif
+    while ifds:
+        (ifd, offset) = ifds.pop(0)
+        try:
+            count = unpack(bo + 'H', tiff[offset:offset+2])[0]
+        except Exception:
+            debug(2, 'bad EXIF IFD offset', ifd, offset)
+            continue
+        for n in xrange(count):
+            entry = tiff[offset+2+12*n:offset+14+12*n]
+            if len(entry) < 12: break
+            (tag, type, num) = unpack(bo + 'HHL', entry[:8])
+            if ifd == 'Image' and tag in c_exif_ifds:
+                if wanted is None or subifds.has_key(c_exif_ifds[tag]):
+                    ifds.append((c_exif_ifds[tag],
+                                 unpack(bo + 'L', entry[8:])[0]))
+                continue
+            name = (wanted is None and [c_exif_tags] or [wanted])[0].get(
+                        (ifd, tag), None)
+            if name is None or not c_exif_types.has_key(type): continue
+            value = exifValue(tiff, bo, entry, type, num)
+            if value is not None: exif[name] = value
+    return exif
+
+def readExif(fobj, tags=None):
+    """Reads the EXIF date and GPS tags of a Jpeg file (a file name or a
+    file-like object) without the IPTC data, see readExifTags. Only the
+    markers up to the APP1 Exif segment are read."""
+    if duck_typed(fobj, 'read'): fh = fobj
+    else: fh = file(fobj, 'rb', 0)
+    try:
+        fh.seek(0, 0)
+        scanner = JpegMarkerScanner(fh, bounded=True)
+        try: soi = scanner.read(2)
+        except EOFException: return {}
+        if soi != '\xff\xd8': return {}
+        while 1:
+            marker = scanner.nextMarker()
+            if marker in (None, 0, 0xd9, 0xda): return {}
+            length = scanner.variableLength()
+            if marker == 0xe1:
+                data = scanner.peek(length)
+                if data[:6] == 'Exif\x00\x00':
+                    return readExifTags(data[6:], tags)
+            scanner.skip(length)
+    finally:
+        if fh is not fobj: fh.close()
+
+def gpsInfo(exif):
+    """Returns the coordinates of an EXIF dict as {'latref': 'S',
+    'latdeg': ..., 'latmin': ..., 'latsec': ..., 'longref': 'W',
+    'longdeg': ..., 'longmin': ..., 'longsec': ...}, the numbers as
+    Fractions. Empty if the file has no usable GPS position."""
+    try:
+        (latref, lat, longref, long) = [exif[name] for name in c_exif_gps]
+        gps = {'latref': latref, 'longref': longref}
+        (gps['latdeg'], gps['latmin'], gps['latsec']) = lat
+        (gps['longdeg'], gps['longmin'], gps['longsec']) = long
+    except (KeyError, TypeError, ValueError):
+        return {}
+    return gps
+
+def exifValue(tiff, bo, entry, type, num):
+    """Decodes the value of a 12 byte IFD entry; None if it is out of
+    the TIFF data."""
+    (size, fmt) = c_exif_types[type]
+    if size * num <= 4: raw = entry[8:8+size*num]
+    else:
+        start = unpack(bo + 'L', entry[8:])[0]
+        raw = tiff[start:start+size*num]
+    if len(raw) < size * num: return None
+    if fmt == 's':
+        value = raw.split('\x00', 1)[0]
+        if type == 2 and len(value) == 19 and value[4:5] == ':':
+            try: return datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
+            except ValueError: pass
+        return value
+    values = unpack(bo + fmt * num, raw)
+    if len(fmt) == 2:
+        # a zero denominator means "unknown" for some cameras
+        values = [(d and [Fraction(n, d)] or [Fraction(0)])[0]
+                  for (n, d) in zip(values[::2], values[1::2])]
+    if num == 1: return values[0]
+    return list(values)
+
+def exifEncode(name, value, bo):
+    """Encodes value for the EXIF tag name as (type, count, bytes)."""
+    (type, count) = c_exif_formats.get(name, (2, None))
+    if type == 2:
+        if isinstance(value, datetime):
+            value = value.strftime('%Y:%m:%d %H:%M:%S')
+        raw = str(value) + '\x00'
+        return (type, len(raw), raw)
+    if not isinstance(value, (list, tuple)): value = [value]
+    if len(value) != count:
+        raise ValueError('%s needs %d values' % (name, count))
+    if type in (1, 3):
+        fmt = c_exif_types[type][1]
+        return (type, count, pack(bo + fmt * count, *value))
+    values = []
+    for v in value:
+        v = Fraction(v).limit_denominator(0xffffffffL)
+        values.extend([v.numerator, v.denominator])
+    return (type, count, pack(bo + 'L' * len(values), *values))
+
+def exifReadIFD(tiff, bo, offset):
+    """Returns the entries of the IFD at offset as [tag, type, count,
+    value field, position] lists, and the offset of the next IFD."""
+    entries = []
+    try: count = unpack(bo + 'H', str(tiff[offset:offset+2]))[0]
+    except Exception: return (entries, 0)
+    for n in xrange(count):
+        pos = offset + 2 + 12 * n
+        entry = str(tiff[pos:pos+12])
+        if len(entry) < 12: return (entries, 0)
+        entries.append(list(unpack(bo + 'HHL', entry[:8])) + [entry[8:], pos])
+    try: nxt = unpack(bo + 'L', str(tiff[pos+12:pos+16]))[0]
+    except Exception: nxt = 0
+    return (entries, nxt)
+
+def exifAppend(out, data):
+    """Appends data to the bytearray out at a word boundary, returns its
+    offset."""
+    if len(out) % 2: out.append(0)
+    offset = len(out)
+    out.extend(data)
+    return offset
+
+def exifUpdateIFD(out, bo, entries, changes, nxt, keep=False):
+    """Makes changes ({tag: (type, count, bytes) or None to delete}) to
+    the IFD with the given entries in out. Values that have the same type
+    and size as before are overwritten where they are; otherwise a new
+    copy of the IFD is appended. Returns the offset of the new copy, None
+    if it was not needed, or 0 if the IFD ended up empty (unless keep)."""
+    existing = dict([(e[0], e) for e in entries])
+    done = {}
+    for (tag, new) in changes.items():
+        e = existing.get(tag, None)
+        if new is None or e is None or e[1:3] != list(new[:2]): continue
+        raw = new[2]
+        if len(raw) <= 4:
+            e[3] = raw.ljust(4, '\x00')
+            out[e[4]+8:e[4]+12] = e[3]
+        else:
+            start = unpack(bo + 'L', e[3])[0]
+            if start + len(raw) > len(out): continue
+            out[start:start+len(raw)] = raw
+        done[tag] = True
+    if not [tag for (tag, new) in changes.items()
+            if not done.has_key(tag) and (new is not None
+                                          or existing.has_key(tag))]:
+        return None
+    tags = existing.keys() + [tag for tag in changes.keys()
+                              if not existing.has_key(tag)]
+    tags.sort()
+    ifd = []
+    for tag in tags:
+        if changes.has_key(tag) and not done.has_key(tag):
+            if changes[tag] is None: continue
+            (type, count, raw) = changes[tag]
+            if len(raw) <= 4: field = raw.ljust(4, '\x00')
+            else: field = pack(bo + 'L', exifAppend(out, raw))
+        else:
+            (type, count, field) = existing[tag][1:4]
+        ifd.append(pack(bo + 'HHL', tag, type, count) + field)
+    if not ifd and not keep: return 0
+    return exifAppend(out, pack(bo + 'H', len(ifd)) + ''.join(ifd)
+                      + pack(bo + 'L', nxt))
+
+def writeExifTags(tiff, changes):
+    """Returns the TIFF structure of an APP1 Exif segment (the bytes
+    after 'Exif\\0\\0') with changes made: a dict of exiv2 tag names (see
+    c_exif_tags) to their new values, or to None to delete the tag. An
+    empty or unreadable tiff gets a new EXIF structure.
+
+    Nothing is moved: a value of the same type and size is overwritten in
+    place, and an IFD that changes shape is appended as a new copy with
+    the old one left unused. So the offsets the rest of the data (maker
+    notes, the thumbnail) rely on stay valid."""
+    if tiff[:4] == 'II*\x00': bo = '<'
+    elif tiff[:4] == 'MM\x00*': bo = '>'
+    else: (bo, tiff) = ('>', 'MM\x00*' + pack('>LHL', 8, 0, 0))
+    out = bytearray(tiff)
+    byifd = {}
+    for (name, value) in changes.items():
+        (ifd, tag) = c_exif_tags_r[name]
+        if value is not None: value = exifEncode(name, value, bo)
+        byifd.setdefault(ifd, {})[tag] = value
+
+    ifd0 = unpack(bo + 'L', tiff[4:8])[0]
+    (entries0, next0) = exifReadIFD(out, bo, ifd0)
+    pointers = dict([(c_exif_ifds[e[0]], e) for e in entries0
+                     if c_exif_ifds.has_key(e[0])])
+    changes0 = byifd.get('Image', {})
+    for (ifd, tagchanges) in byifd.items():
+        if ifd == 'Image': continue
+        if pointers.has_key(ifd):
+            offset = unpack(bo + 'L', pointers[ifd][3])[0]
+            (entries, nxt) = exifReadIFD(out, bo, offset)
+        else:
+            (entries, nxt) = ([], 0)
+            if ifd == 'GPSInfo' and [v for v in tagchanges.values() if v]:
+                # required in a GPS IFD: version 2.2.0.0
+                tagchanges.setdefault(0, exifEncode(
+                    'Exif.GPSInfo.GPSVersionID', (2, 2, 0, 0), bo))
+        offset = exifUpdateIFD(out, bo, entries, tagchanges, nxt)
+        if offset is None: continue
+        tag = c_exif_ifds_r[ifd]
+        if offset == 0:
+            if pointers.has_key(ifd): changes0[tag] = None
+        else:
+            # an existing pointer is just overwritten
+            changes0[tag] = (4, 1, pack(bo + 'L', offset))
+    if changes0:
+        offset = exifUpdateIFD(out, bo, entries0, changes0, next0, True)
+        if offset is not None: out[4:8] = pack(bo + 'L', offset)
+    return str(out)
+
+
 class IPTCInfo(object):
     """info = IPTCInfo('image filename goes here')
 
@@ -422,41 +1232,89 @@ class IPTCInfo(object):
 
     If force==True, than forces an object to always be returned. This
     allows you to start adding stuff to files that don't have IPTC info
-    and then save it."""
+    and then save it.
+
+    If readonly==True, only the Jpeg header is read: files are opened
+    unbuffered, the header is taken in one 64 KB read (a second one only
+    when its segments run past that) and the IIM data is parsed from the
+    APP13 bytes already read. The number of bytes and read calls it took
+    are left in bytesRead and readCalls.
+    Read-only objects cannot be saved.
+
+    If exif==True, the EXIF date and GPS tags are read from the APP1
+    segment in the same pass over the Jpeg header and left in the exif
+    dict (see readExifTags), so one IPTCInfo gives both kinds of data.
+    If imageinfo==True, the size of the image (from the start of frame
+    marker) and its EXIF orientation are left in the imageInfo dict.
+
+    The other Photoshop resources of the APP13 block are listed in
+    adobeResources; see getResource and dropResource.
+
+    File can also be an image already in memory: a bytearray, mmap,
+    buffer or memoryview (use IPTCInfo.fromBuffer for a str, which would
+    be taken for a filename). It is parsed in place with BufferScanner,
+    and saveInto writes the changed image into another buffer."""
 
     def __init__(self, fobj, force=False, inp_charset=sys_enc,
+                              readonly=False, exif=False, imageinfo=False,
                               *args, **kwds):
         # Open file and snarf data from it.
         self._error = None
+        self._iimSource = None
+        self.exif = (exif and [{}] or [None])[0]
+        self.imageInfo = (imageinfo and [{}] or [None])[0]
+        self._exifChanges = {}
+        self.adobeResources = []
+        self._adobeData = None
+        self._droppedResources = {}
+        self.readonly = readonly
+        self.bytesRead = 0
+        self.readCalls = 0
         self._data = IPTCData({'supplemental category': [], 'keywords': [],
                                                       'contact': []})
-        if duck_typed(fobj, 'read'):
+        self._buf = None
+        if isinstance(fobj, (bytearray, memoryview, buffer, mmap.mmap)):
+            self._filename = self._fh = None
+            self._buf = asBuffer(fobj)
+        elif duck_typed(fobj, 'read'):
             self._filename = None
             self._fh = fobj
         else:
             self._filename = fobj
 
-        fh = self._getfh()
+        if self._buf is None:
+            fh = self._getfh(buffering=(readonly and [0] or [-1])[0])
+        else: fh = None
         self.inp_charset = inp_charset
         self.out_charset = 'utf_8'
 
         datafound = self.scanToFirstIMMTag(fh)
         if datafound or force:
             # Do the real snarfing here
-            if datafound: self.collectIIMInfo(fh)
+            if (datafound and (readonly or self._buf is not None)
+                    and self._iimSource is not None):
+                self.collectIIMData(*self._iimSource)
+            elif datafound: self.collectIIMInfo(fh)
         else:
             self.log("No IPTC data found.")
             self._closefh(fh)
             raise Exception("No IPTC data found.")
         self._closefh(fh)
 
+    def fromBuffer(cls, data, *args, **kwds):
+        """IPTCInfo of a Jpeg in memory; data may also be a str."""
+        if isinstance(data, str): data = buffer(data)
+        return cls(data, *args, **kwds)
+    fromBuffer = classmethod(fromBuffer)
+
     def _closefh(self, fh):
         if fh and self._filename is not None: fh.close()
 
-    def _getfh(self, mode='r'):
+    def _getfh(self, mode='r', buffering=-1):
         assert self._filename is not None or self._fh is not None
         if self._filename is not None:
-            fh = file(self._filename, (mode + 'b').replace('bb', 'b'))
+            fh = file(self._filename, (mode + 'b').replace('bb', 'b'),
+                      buffering)
             if not fh:
                 self.log("Can't open file")
                 return None
@@ -476,7 +1334,9 @@ class IPTCInfo(object):
     error = property(get_error, set_error)
 
     def save(self, options=None):
-        """Saves Jpeg with IPTC data back to the same file it came from."""
+        """Saves Jpeg with IPTC data back to the same file it came from.
+        Returns SKIPPED, without writing, if the file already has that
+        data (see iimUnchanged)."""
         assert self._filename is not None
         return self.saveAs(self._filename, options)
 
@@ -485,78 +1345,187 @@ class IPTCInfo(object):
         return 'POS=%d\n' % fh.tell()
 
     def saveAs(self, newfile, options=None):
-        """Saves Jpeg with IPTC data to a given file name."""
+        """Saves Jpeg with IPTC data to a given file name.
+
+        Saving to the same file writes the APP13 block in place when it
+        fits and the backup mode allows it (see canSaveInPlace); anything
+        else is written to a temporary file next to the target and renamed
+        over it, keeping the old file as 'newfile~'."""
         assert self._filename is not None
+        if self.readonly:
+            raise Exception('IPTCInfo was opened read-only')
+        if options is None: options = {}
         # Open file and snarf data from it.
+        samefile = os.path.abspath(newfile) == os.path.abspath(self._filename)
+        if samefile and self.iimUnchanged(options):
+            debug(1, 'same IPTC data, not writing')
+            return SKIPPED
         fh = self._getfh()
         fh.seek(0, 0)
         if not self.fileIsJpeg(fh):
             self.log("Source file is not a Jpeg; I can only save Jpegs. Sorry.")
             return None
-        ret = self.jpegCollectFileParts(fh, options)
-        self._closefh(fh)
+        if samefile and self.canSaveInPlace(options):
+            try: written = self.jpegSaveInPlace(fh, self.packedIIMData())
+            except:
+                self._closefh(fh)
+                raise
+            if written:
+                self._closefh(fh)
+                return True
+        try: (head, end) = self.jpegNewHead(fh, options)
+        except:
+            self._closefh(fh)
+            raise
+
+        debug(1, 'writing...')
+        # a temp file next to the target, so the final rename is atomic
+        # and never a copy between devices
+        try:
+            (tmpfd, tmpfn) = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(newfile)),
+                    prefix='.' + os.path.basename(newfile), suffix='.tmp')
+        except:
+            self._closefh(fh)
+            raise
+        tmpfh = os.fdopen(tmpfd, 'wb')
+        try:
+            tmpfh.write(head)
+            debug(2, self._filepos(tmpfh))
+            # the image data goes straight from the source file
+            copyFileRange(fh, tmpfh, end)
+            debug(2, self._filepos(tmpfh))
+            tmpfh.flush()
+            os.fsync(tmpfh.fileno())
+            tmpfh.close()
+            self._closefh(fh)
+
+            #put the successfully written file in place of the given file
+            if os.path.exists(newfile):
+                shutil.copymode(newfile, tmpfn)
+                backupFile(newfile, newfile + '~',
+                           options.get('backup', SAVE_BACKUP))
+            replaceFile(tmpfn, newfile)
+        except:
+            tmpfh.close()
+            self._closefh(fh)
+            if os.path.exists(tmpfn):
+                os.unlink(tmpfn)
+            raise
+        self._exifChanges = {}
+        return True
+
+    def canSaveInPlace(self, options):
+        """True if saving back to the file may overwrite its APP13 block
+        in place: only IIM changes, and a backup mode that keeps the old
+        data safe. 'reflink' clones the file as 'file~' first and falls
+        back to a rewrite if it can't; 'off' asks for no backup. A hard
+        link would share the very data being overwritten."""
+        if (self._exifChanges
+                or [k for k in ('discardAdobeParts', 'discardAppParts',
+                                'forceRewrite') if options.has_key(k)]):
+            return False
+        how = options.get('backup', SAVE_BACKUP)
+        if how == 'off' or not how:
+            return True
+        if how == 'reflink':
+            return reflinkFile(self._filename, self._filename + '~')
+        return False
+
+    def iimUnchanged(self, options=None):
+        """True if saving with the given options would write the very IIM
+        data the APP13 block of the file already has, and nothing else
+        (no EXIF changes, dropped resources or discard options)."""
+        if options is None: options = {}
+        if (self._exifChanges or self._droppedResources
+                or SURELY_WRITE_CHARSET_INFO
+                or [k for k in ('discardAdobeParts', 'discardAppParts',
+                                'forceRewrite') if options.has_key(k)]):
+            return False
+        old = self.getResource(0x0404)
+        return old is not None and str(old) == self.packedIIMData()
+
+    def saveInto(self, out, options=None):
+        """Writes the Jpeg with the IPTC data into out, a writable buffer
+        (bytearray, mmap or writable memoryview) at least as long as the
+        new image, for IPTCInfo objects made from a buffer. The image data
+        is copied from buffer to buffer, see copyBufferRange; out must not
+        be the buffer the image is read from. Takes the options of saveAs
+        and returns the length of the new image."""
+        assert self._buf is not None
+        if self.readonly:
+            raise Exception('IPTCInfo was opened read-only')
+        if options is None: options = {}
+        scanner = BufferScanner(self._buf)
+        if scanner.peek(3) != '\xff\xd8\xff':
+            self.log("Source file is not a Jpeg; I can only save Jpegs. Sorry.")
+            return None
+        (head, end) = self.jpegNewHead(None, options, scanner)
+        size = len(head) + len(self._buf) - end
+        if len(out) < size:
+            raise ValueError('buffer too small, %d bytes needed' % size)
+        out[:len(head)] = head
+        copyBufferRange(self._buf, end, out, len(head))
+        self._exifChanges = {}
+        return size
+
+    def jpegNewHead(self, fh, options, scanner=None):
+        """Returns everything of the file to save up to the image data
+        (with the new IPTC data in it), and the offset in the old file
+        where the rest to copy starts."""
+        ret = self.jpegCollectFileParts(fh, options.has_key('discardAppParts'),
+                                        scanner)
         if ret is None:
             self.log("collectfileparts failed")
             raise Exception('collectfileparts failed')
 
-        (start, end, adobe) = ret
-        debug(2, 'start: %d, end: %d, adobe:%d' % tuple(map(len, ret)))
-        self.hexDump(start), len(end)
+        (start, end, adobe, rest) = ret
+        debug(2, 'start: %d, end at: %d, adobe:%d' % (len(start), end, len(adobe)))
         debug(3, 'adobe1', adobe)
-        if options is not None and options.has_key('discardAdobeParts'):
+        if options.has_key('discardAdobeParts'):
             adobe = None
         debug(3, 'adobe2', adobe)
 
-        debug(1, 'writing...')
-        (tmpfd, tmpfn) = tempfile.mkstemp()
-        os.close(tmpfd)
-        #~ fh = os.fdopen(tmpfh, 'wb')
-        tmpfh = open(tmpfn, 'wb')
-        #fh = StringIO()
-        if not tmpfh:
-            self.log("Can't open output file")
-            return None
-        debug(3, len(start), len(end))
-        tmpfh.write(start)
+        head = [start]
         # character set
-        ch = self.c_charset_r.get(
-                (self.out_charset is None and [self.inp_charset]
-                  or [self.out_charset])[0], None)
+        ch = self.c_charset_r.get(self.outCharset(), None)
         # writing the character set is not the best practice
         # - couldn't find the needed place (record) for it yet!
         if SURELY_WRITE_CHARSET_INFO and ch is not None:
-            tmpfh.write(pack("!BBBHH", 0x1c, 1, 90, 4, ch))
+            head.append(pack("!BBBHH", 0x1c, 1, 90, 4, ch))
 
-        debug(2, self._filepos(tmpfh))
-        data = self.photoshopIIMBlock(adobe, self.packedIIMData())
+        data = self.photoshopIIMBlock(adobe, self.packedIIMData(),
+                                      options.get('reserve', APP13_RESERVE))
         debug(3, len(data), self.hexDump(data))
-        tmpfh.write(data)
-        debug(2, self._filepos(tmpfh))
-        tmpfh.write(end)
-        debug(2, self._filepos(tmpfh))
-        tmpfh.flush()
-        tmpfh.close()
-
-        #print tmpfh, tmpfn, newfile
-        #copy the successfully written file back to the given file
-        if hasattr(tmpfh, 'getvalue'): #StringIO
-            fh2 = open(newfile, 'wb')
-            fh2.truncate()
-            fh2.seek(0,0)
-            tmpfh = open(tmpfn, 'rb')
-            #~ fh.seek(0, 0)
-            while 1:
-                buf = tmpfh.read(8192)
-                if not buf: break
-                fh2.write(buf)
-            fh2.flush()
-            fh2.close()
-            tmpfh.close()
-            os.unlink(tmpfn)
-        else:
-            if os.path.exists(newfile):
-                shutil.move(newfile, newfile + '~')
-            shutil.move(tmpfn, newfile)
+        head.append(data)
+        head.append(rest)
+        return (''.join(head), end)
+
+    def jpegSaveInPlace(self, fh, data):
+        """Overwrites the APP13 block of the file in place with the given
+        IIM data, keeping the other Adobe parts. The block keeps its size:
+        the space left over goes into a padding resource. Returns False,
+        without touching the file, if there is no APP13 block or the new
+        one does not fit in it."""
+        found = self.jpegFindApp13(fh)
+        if found is None: return False
+        (offset, partdata) = found
+        adobe = self.collectAdobeParts(partdata)
+        block = self.photoshopIIMBlock(adobe, data)
+        gap = len(partdata) + 4 - len(block)
+        if gap < 0 or gap % 2 != 0 or 0 < gap < self.c_padding_min:
+            self.log("jpegSaveInPlace: new APP13 block does not fit")
+            return False
+        if gap: block = self.photoshopIIMBlock(adobe, data, gap)
+        debug(2, 'jpegSaveInPlace: APP13 at %d, %d bytes' % (offset, len(block)))
+        out = self._getfh('r+')
+        try:
+            out.seek(offset, 0)
+            out.write(block)
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
         return True
 
     def __del__(self):
@@ -578,6 +1547,26 @@ class IPTCInfo(object):
     supplementalCategories = property(*_getSetSomeList('supplemental category'))
     contacts = property(*_getSetSomeList('contact'))
 
+    def setExif(self, name, value):
+        """Changes the EXIF tag name (an exiv2 name from c_exif_tags) to
+        value, None deletes it. Changes are written by the next save(),
+        together with the IPTC data, in one rewrite of the file."""
+        if not c_exif_tags_r.has_key(name):
+            raise KeyError("Key %s is not in %s!" % (name, c_exif_tags_r.keys()))
+        if self.exif is not None and not self._exifChanges.has_key(name):
+            # the file already has it: nothing to write
+            if isinstance(value, tuple): same = list(value)
+            else: same = value
+            if self.exif.get(name) == same: return
+        self._exifChanges[name] = value
+        if self.exif is not None:
+            if value is None: self.exif.pop(name, None)
+            else: self.exif[name] = value
+
+    def delExif(self, name):
+        """Deletes the EXIF tag name on the next save()."""
+        self.setExif(name, None)
+
     def __str__(self):
         return ('charset: ' + self.inp_charset + '\n'
                 + str(dict([(self._data.keyAsStr(k), v)
@@ -641,11 +1630,11 @@ class IPTCInfo(object):
         # dump our stuff
         for k, v in self._data.iteritems():
             if not isinstance(v, list):
-                key = re.sub('/', '-', re.sub(' +', ' ', self._data.keyAsStr(k)))
+                key = xmlTagName(self._data.keyAsStr(k))
                 out.append( P("<%s>%s</%s>" % (key, v, key)) )
 
         # print keywords
-        kw = self.keywords()
+        kw = self.keywords
         if kw and len(kw) > 0:
             out.append( P("<keywords>") )
             off += 1
@@ -654,7 +1643,7 @@ class IPTCInfo(object):
             out.append( P("</keywords>") )
 
         # print supplemental categories
-        sc = self.supplementalCategories()
+        sc = self.supplementalCategories
         if sc and len(sc) > 0:
             out.append( P("<supplemental_categories>") )
             off += 1
@@ -664,7 +1653,7 @@ class IPTCInfo(object):
             out.append( P("</supplemental_categories>") )
 
         # print contacts
-        kw = self.contacts()
+        kw = self.contacts
         if kw and len(kw) > 0:
             out.append( P("<contacts>") )
             off += 1
@@ -679,7 +1668,7 @@ class IPTCInfo(object):
         # export to file if caller asked for it.
         if len(filename) > 0:
             xmlout = file(filename, 'wb')
-            xmlout.write(out)
+            xmlout.write(u''.join(out).encode('utf_8'))
             xmlout.close()
 
         return ''.join(out)
@@ -698,7 +1687,7 @@ class IPTCInfo(object):
         which maps IPTC dataset names into column names for the database
         table. Optionally pass in a ref to a hash of extra data which will
         also be included in the insert statement. Keys in that hash must
-        be valid column names."""
+        be valid column names. See export_sqlite for loading many files."""
 
         if (tablename is None or mappings is None): return None
         statement = columns = values = None
@@ -725,6 +1714,27 @@ class IPTCInfo(object):
         use smart scanning for Jpegs or blind scanning for other file
         types."""
         ## assert isinstance(fh, file)
+        if self._buf is not None:
+            scanner = BufferScanner(self._buf)
+            if scanner.peek(3) == '\xff\xd8\xff':
+                self.log("Buffer is Jpeg, proceeding with JpegScan")
+                return self.jpegScan(None, scanner)
+            self.log("Buffer not a JPEG, trying blindScan")
+            data = scanner.peek(8192 + 3)
+            (offset, pos) = self.blindScanData(data)
+            if offset: self._iimSource = (data, pos)
+            return offset
+        if self.readonly:
+            # Check the Jpeg signature from the scanner's own first read
+            # instead of fileIsJpeg, which reads and rewinds.
+            scanner = JpegMarkerScanner(fh, bounded=True)
+            head = scanner.peek(3)
+            if head[:2] == '\xff\xd8' and head[2:] == '\xff':
+                self.log("File is Jpeg, proceeding with bounded JpegScan")
+                return self.jpegScan(fh, scanner)
+            fh.seek(0, 0)
+            self.log("File not a JPEG, trying blindScan")
+            return self.blindScan(fh)
         if self.fileIsJpeg(fh):
             self.log("File is Jpeg, proceeding with JpegScan")
             return self.jpegScan(fh)
@@ -766,7 +1776,7 @@ class IPTCInfo(object):
     c_marker_err = {0: "Marker scan failed",
                                     0xd9:  "Marker scan hit end of image marker",
                                     0xda: "Marker scan hit start of image data"}
-    def jpegScan(self, fh): #OK#
+    def jpegScan(self, fh, scanner=None): #OK#
         """Assuming the file is a Jpeg (see above), this will scan through
         the markers looking for the APP13 marker, where IPTC/IIM data
         should be found. While this isn't a formally defined standard, all
@@ -774,30 +1784,89 @@ class IPTCInfo(object):
         the data in APP13."""
         # Skip past start of file marker
         ## assert isinstance(fh, file)
-        try: (ff, soi) = self.readExactly(fh, 2)
-        except EOFException: return None
+        if scanner is None: scanner = JpegMarkerScanner(fh)
+        try: soi = scanner.read(2)
+        except EOFException:
+            self._countReads(scanner)
+            return None
 
-        if not (ord(ff) == 0xff and ord(soi) == 0xd8):
+        if soi != '\xff\xd8':
             self.error = "JpegScan: invalid start of file"
             self.log(self.error)
+            self._countReads(scanner)
             return None
         # Scan for the APP13 marker which will contain our IPTC info (I hope).
         while 1:
-            err = None
-            marker = self.jpegNextMarker(fh)
-            if ord(marker) == 0xed: break #237
+            marker = scanner.nextMarker()
+            if marker == 0xed: break #237
 
-            err = self.c_marker_err.get(ord(marker), None)
-            if err is None and self.jpegSkipVariable(fh) == 0:
-                err = "JpegSkipVariable failed"
+            err = self.c_marker_err.get(marker or 0, None)
             if err is not None:
                 self.error = err
                 self.log(err)
+                self._countReads(scanner)
                 return None
+            self.log("JpegScan: at marker %02X (%d)" % (marker, marker))
+            self.jpegSkipSegment(scanner, marker)
 
         # If were's here, we must have found the right marker. Now
-        # blindScan through the data.
-        return self.blindScan(fh, MAX=self.jpegGetVariableLength(fh))
+        # blindScan through the data, which is already in the buffer.
+        MAX = scanner.variableLength()
+        start = scanner.tell()
+        data = scanner.peek(MAX + 3)
+        self._adobeData = data[:MAX]
+        self.adobeResources = self.indexAdobeParts(self._adobeData)
+        (offset, pos) = self.blindScanData(data, MAX)
+        if self.wantsMoreSegments():
+            # EXIF or the frame comes after the APP13 block, go on to it
+            scanner.skip(MAX)
+            while 1:
+                marker = scanner.nextMarker()
+                if self.c_marker_err.get(marker or 0, None): break
+                self.jpegSkipSegment(scanner, marker)
+                if not self.wantsMoreSegments(): break
+        self._countReads(scanner)
+        if offset:
+            self._iimSource = (data, pos)
+            if fh is not None: fh.seek(start + pos, 0)
+        return offset
+
+    # Start of frame markers: all of 0xC0-0xCF but DHT (0xC4), JPG (0xC8)
+    # and DAC (0xCC), True for the progressive ones
+    c_sof_markers = dict([(m, m in (0xc2, 0xc6, 0xca, 0xce))
+                          for m in xrange(0xc0, 0xd0)
+                          if m not in (0xc4, 0xc8, 0xcc)])
+
+    def wantsMoreSegments(self):
+        """True while the EXIF data or image info asked for are not found."""
+        return (self.exif == {} or (self.imageInfo is not None
+                                    and not self.imageInfo.has_key('width')))
+
+    def jpegSkipSegment(self, scanner, marker):
+        """Skips the segment the scanner is on, reading the EXIF data
+        from it first if it is the APP1 Exif segment we're looking for,
+        or the image size if it is the start of frame (see imageInfo)."""
+        length = scanner.variableLength()
+        if marker == 0xe1 and (self.exif == {} or self.imageInfo == {}):
+            data = scanner.peek(length)
+            if data[:6] == 'Exif\x00\x00':
+                if self.exif == {}: self.exif = readExifTags(data[6:])
+                if self.imageInfo == {}:
+                    exif = self.exif or readExifTags(data[6:],
+                                                     ['Exif.Image.Orientation'])
+                    if exif.has_key('Exif.Image.Orientation'):
+                        self.imageInfo['orientation'] = \
+                            exif['Exif.Image.Orientation']
+        elif (self.imageInfo is not None and self.c_sof_markers.has_key(marker)
+                and not self.imageInfo.has_key('width')):
+            data = scanner.peek(6)
+            if len(data) == 6:
+                (precision, height, width, components) = unpack("!BHHB", data)
+                self.imageInfo.update({'width': width, 'height': height,
+                                       'components': components,
+                                       'precision': precision,
+                                       'progressive': self.c_sof_markers[marker]})
+        scanner.skip(length)
 
     def jpegNextMarker(self, fh): #OK#
         """Scans to the start of the next valid-looking marker. Return
@@ -865,6 +1934,10 @@ class IPTCInfo(object):
 
         return (rSave is not None and [temp] or [True])[0]
 
+    def _countReads(self, scanner):
+        self.bytesRead = scanner.bytesRead
+        self.readCalls = scanner.reads
+
     c_charset = {100: 'iso8859_1', 101: 'iso8859_2', 109: 'iso8859_3',
                   110: 'iso8859_4', 111: 'iso8859_5', 125: 'iso8859_7',
                   127: 'iso8859_6', 138: 'iso8859_8',
@@ -878,56 +1951,74 @@ class IPTCInfo(object):
         depending on how other programs choose to store IIM.)"""
 
         ## assert isinstance(fh, file)
-        assert duck_typed(fh, 'read')
-        offset = 0
+        assert duck_typed(fh, ['read', 'seek', 'tell'])
         # keep within first 8192 bytes
         # NOTE: this may need to change
+        start = fh.tell()
+        data = fh.read(MAX + 3)
+        self.bytesRead += len(data)
+        self.readCalls += 1
+        (offset, pos) = self.blindScanData(data, MAX)
+        if offset: fh.seek(start + pos, 0)
+        return offset
+
+    def blindScanData(self, data, MAX=8192):
+        """blindScan over a string already in memory. Returns the tuple
+        (offset, pos): offset is what blindScan returns, pos is the index
+        of the IIM start in data (or None)."""
         self.log('blindScan: starting scan, max length %d' % MAX)
-
+        offset = pos = 0
+        length = len(data)
         # start digging
         while offset <= MAX:
-            try: temp = self.readExactly(fh, 1)
-            except EOFException:
-                self.log("BlindScan: hit EOF while scanning");
-                return None
             # look for tag identifier 0x1c
-            if ord(temp) == 0x1c:
-                # if we found that, look for record 2, dataset 0
-                # (record version number)
-                (record, dataset) = fh.read(2)
-                if ord(record) == 1 and ord(dataset) == 90:
-                    # found character set's record!
-                    try:
-                        temp = self.readExactly(fh, self.jpegGetVariableLength(fh))
-                        try:
-                            cs = unpack('!H', temp)[0]
-                        except:
-                            print 'WARNING: problems with charset recognition', repr(temp)
-                            cs = None
-                        if cs in self.c_charset:
-                            self.inp_charset = self.c_charset[cs]
-                        self.log("BlindScan: found character set '%s' at offset %d"
-                                          % (self.inp_charset, offset))
-                    except EOFException:
-                        pass
-
-                elif ord(record) == 2:
-                    # found it. seek to start of this tag and return.
-                    self.log("BlindScan: found IIM start at offset %d" % offset);
-                    try: self.seekExactly(fh, -3) # seek rel to current position
-                    except EOFException:
-                        return None
-                    return offset
+            stop = pos + MAX - offset + 1
+            idx = data.find('\x1c', pos, stop)
+            if idx < 0:
+                if stop > length:
+                    self.log("BlindScan: hit EOF while scanning");
+                    return (None, None)
+                break
+            offset += idx - pos
+            if idx + 3 > length:
+                self.log("BlindScan: hit EOF while scanning");
+                return (None, None)
+            # if we found that, look for record 2, dataset 0
+            # (record version number)
+            (record, dataset) = (ord(data[idx+1]), ord(data[idx+2]))
+            if record == 1 and dataset == 90:
+                # found character set's record!
+                pos = idx + 3
+                if pos + 2 <= length:
+                    size = unpack('!H', data[pos:pos+2])[0]
+                    size = (size >= 2 and [size - 2] or [0])[0]
+                    pos += 2
                 else:
-                    # didn't find it. back up 2 to make up for
-                    # those reads above.
-                    try: self.seekExactly(fh, -2) # seek rel to current position
-                    except EOFException: return None
+                    size = 0
+                    pos = length
+                temp = data[pos:pos+size]
+                pos += size
+                if len(temp) == size:
+                    try:
+                        cs = unpack('!H', temp)[0]
+                    except:
+                        print 'WARNING: problems with charset recognition', repr(temp)
+                        cs = None
+                    if cs in self.c_charset:
+                        self.inp_charset = self.c_charset[cs]
+                    self.log("BlindScan: found character set '%s' at offset %d"
+                                      % (self.inp_charset, offset))
+            elif record == 2:
+                # found it.
+                self.log("BlindScan: found IIM start at offset %d" % offset);
+                return (offset, idx)
+            else:
+                # didn't find it, keep scanning past the tag byte.
+                pos = idx + 1
 
-            # no tag, keep scanning
             offset += 1
 
-        return False
+        return (False, None)
 
     def collectIIMInfo(self, fh): #OK#
         """Assuming file is seeked to start of IIM data (using above),
@@ -948,40 +2039,78 @@ class IPTCInfo(object):
                               'length': length}
             debug(1, '\n'.join(['%s\t: %s' % (k, v) for k, v in alist.iteritems()]))
             value = fh.read(length)
+            self._storeIIM(dataset, value, 0, len(value))
 
-            try: value = unicode(value, encoding=self.inp_charset, errors='strict')
-            except:
-                self.log('Data "%s" is not in encoding %s!' % (value, self.inp_charset))
-                value = unicode(value, encoding=self.inp_charset, errors='replace')
+    def collectIIMData(self, data, offset=0):
+        """Same as collectIIMInfo, but reads the IIM datasets from a string
+        already in memory, starting at offset."""
+        length = len(data)
+        while offset + 5 <= length:
+            (tag, record, dataset, size) = unpack_from("!BBBH", data, offset)
+            # bail if we're past end of IIM record 2 data
+            if not (tag == 0x1c and record == 2): return None
+            offset += 5
+            self._storeIIM(dataset, data, offset,
+                           max(0, min(size, length - offset)))
+            offset += size
 
-            # try to extract first into _listdata (keywords, categories)
-            # and, if unsuccessful, into _data. Tags which are not in the
-            # current IIM spec (version 4) are currently discarded.
-            if self._data.has_key(dataset) and isinstance(self._data[dataset], list):
-                self._data[dataset].append( value )
-            elif dataset != 0:
-                self._data[dataset] = value
+    def _storeIIM(self, dataset, buf, offset, length):
+        # The value is kept undecoded in _data (see IPTCData.addRaw),
+        # appended to the list datasets (keywords, categories). The
+        # record version (dataset 0) is not kept.
+        if dataset != 0:
+            self._data.addRaw(dataset, buf, offset, length, self.inp_charset)
 
     #######################################################################
     # File Saving
     #######################################################################
 
-    def jpegCollectFileParts(self, fh, discardAppParts=False):
+    def jpegFindApp13(self, fh):
+        """Finds the first APP13 block of a Jpeg. Returns the file offset
+        of its marker and its contents, or None if the scan hits image
+        data (or anything unexpected) first."""
+        fh.seek(0, 0)
+        scanner = JpegMarkerScanner(fh)
+        try:
+            if scanner.read(2) != '\xff\xd8': return None
+        except EOFException: return None
+        while 1:
+            marker = scanner.nextMarker()
+            if marker is None or self.c_marker_err.has_key(marker): return None
+            offset = scanner.tell() - 2
+            length = scanner.variableLength()
+            if marker == 0xed:
+                try: return (offset, scanner.read(length))
+                except EOFException: return None
+            scanner.skip(length)
+
+    def jpegCollectFileParts(self, fh, discardAppParts=False, scanner=None):
         """Collects all pieces of the file except for the IPTC info that
-        we'll replace when saving. Returns the stuff before the info,
-        stuff after, and the contents of the Adobe Resource Block that the
-        IPTC data goes in. Returns None if a file parsing error occured."""
+        we'll replace when saving. Returns the stuff before the info, the
+        file offset where the stuff after it starts, the contents of
+        the Adobe Resource Block that the IPTC data goes in and the
+        segments to put between the info and the rest of the file. The
+        stuff after the info is not read here, copy it with copyFileRange.
+        Pending EXIF changes (see setExif) are made to the APP1 segment
+        on the way. Returns None if a file parsing error occured."""
 
-        ## assert isinstance(fh, file)
-        assert duck_typed(fh, ['seek', 'read'])
         adobeParts = ''
         start = []
-
-        # Start at beginning of file
-        fh.seek(0, 0)
+        rest = None
+        exifSeen = not self._exifChanges
+        # Where new EXIF goes in start: after SOI, or after APP0 if any
+        afterApp0 = 1
+
+        if scanner is None:
+            ## assert isinstance(fh, file)
+            assert duck_typed(fh, ['seek', 'read', 'tell'])
+            # Start at beginning of file
+            fh.seek(0, 0)
+            scanner = JpegMarkerScanner(fh)
         # Skip past start of file marker
-        (ff, soi) = fh.read(2)
-        if not (ord(ff) == 0xff and ord(soi) == 0xd8):
+        try: soi = scanner.read(2)
+        except EOFException: soi = None
+        if soi != '\xff\xd8':
             self.error = "JpegScan: invalid start of file"
             self.log(self.error)
             return None
@@ -991,189 +2120,241 @@ class IPTCInfo(object):
 
         # Get first marker in file. This will be APP0 for JFIF or APP1 for
         # EXIF.
-        marker = self.jpegNextMarker(fh)
-        app0data = ''
-        app0data = self.jpegSkipVariable(fh, app0data)
-        if app0data is None:
+        marker = scanner.nextMarker()
+        app0data = self.jpegReadVariable(scanner)
+        if marker is None or app0data is None:
             self.error = 'jpegSkipVariable failed'
             self.log(self.error)
             return None
 
-        if ord(marker) == 0xe0 or not discardAppParts:
+        if marker == 0xe0 or not discardAppParts:
+            if marker == 0xe1 and not exifSeen:
+                (app0data, exifSeen) = self.jpegUpdateExif(app0data)
             # Always include APP0 marker at start if it's present.
-            start.append( pack('BB', 0xff, ord(marker)) )
+            start.append( pack('BB', 0xff, marker) )
             # Remember that the length must include itself (2 bytes)
             start.append( pack('!H', len(app0data)+2) )
             start.append( app0data )
+            if marker == 0xe0: afterApp0 = len(start)
         else:
             # Manually insert APP0 if we're trashing application parts, since
             # all JFIF format images should start with the version block.
             debug(2, 'discardAppParts=', discardAppParts)
             start.append( pack("BB", 0xff, 0xe0) )
             start.append( pack("!H", 16) )  # length (including these 2 bytes)
-            start.append( "JFIF" )          # format
+            start.append( "JFIF\x00" )      # format
             start.append( pack("BB", 1, 2) )# call it version 1.2 (current JFIF)
-            start.append( pack('8B', 0) )   # zero everything else
+            start.append( '\x00' * 7 )      # zero everything else
+            afterApp0 = len(start)
 
         # Now scan through all markers in file until we hit image data or
         # IPTC stuff.
-        end = []
         while 1:
-            marker = self.jpegNextMarker(fh)
-            if marker is None or ord(marker) == 0:
+            marker = scanner.nextMarker()
+            if marker is None or marker == 0:
                 self.error = "Marker scan failed"
                 self.log(self.error)
                 return None
             # Check for end of image
-            elif ord(marker) == 0xd9:
+            elif marker == 0xd9:
                 self.log("JpegCollectFileParts: saw end of image marker")
-                end.append( pack("BB", 0xff, ord(marker)) )
+                end = scanner.tell() - 2
                 break
             # Check for start of compressed data
-            elif ord(marker) == 0xda:
+            elif marker == 0xda:
                 self.log("JpegCollectFileParts: saw start of compressed data")
-                end.append( pack("BB", 0xff, ord(marker)) )
+                end = scanner.tell() - 2
                 break
-            partdata = ''
-            partdata = self.jpegSkipVariable(fh, partdata)
+            partdata = self.jpegReadVariable(scanner)
             if not partdata:
                 self.error = "JpegSkipVariable failed"
                 self.log(self.error)
                 return None
-            partdata = str(partdata)
 
             # Take all parts aside from APP13, which we'll replace
             # ourselves.
-            if (discardAppParts and ord(marker) >= 0xe0 and ord(marker) <= 0xef):
+            if (discardAppParts and marker >= 0xe0 and marker <= 0xef):
                 # Skip all application markers, including Adobe parts
-                adobeParts = ''
-            elif ord(marker) == 0xed:
+                if rest is None: adobeParts = ''
+            elif marker == 0xed and rest is None:
                 # Collect the adobe stuff from part 13
                 adobeParts = self.collectAdobeParts(partdata)
-                break
+                end = scanner.tell()
+                if exifSeen: break
+                # the EXIF to change comes later, keep going
+                rest = []
             else:
-                # Append all other parts to start section
-                start.append( pack("BB", 0xff, ord(marker)) )
-                start.append( pack("!H", len(partdata) + 2) )
-                start.append( partdata )
-
-        # Append rest of file to end
-        while 1:
-            buff = fh.read(8192)
-            if buff is None or len(buff) == 0: break
-            end.append(buff)
+                if marker == 0xe1 and not exifSeen:
+                    (partdata, exifSeen) = self.jpegUpdateExif(partdata)
+                # Append all other parts to start (or rest) section
+                (rest is None and [start] or [rest])[0].extend(
+                    [pack("BB", 0xff, marker), pack("!H", len(partdata) + 2),
+                     partdata])
+                if rest is not None and exifSeen:
+                    end = scanner.tell()
+                    break
 
-        return (''.join(start), ''.join(end), adobeParts)
+        if not exifSeen:
+            # no EXIF in the file, add it after SOI and APP0
+            data = 'Exif\x00\x00' + writeExifTags('', self._exifChanges)
+            start.insert(afterApp0,
+                         pack("!BBH", 0xff, 0xe1, len(data) + 2) + data)
+        return (''.join(start), end, adobeParts, ''.join(rest or []))
+
+    def jpegUpdateExif(self, partdata):
+        """Makes the pending EXIF changes to the data of an APP1 segment.
+        Returns the new data and whether it was the Exif segment."""
+        if partdata[:6] != 'Exif\x00\x00': return (partdata, False)
+        data = 'Exif\x00\x00' + writeExifTags(partdata[6:], self._exifChanges)
+        if len(data) > 0xffff - 2:
+            raise Exception('EXIF data does not fit in the APP1 segment')
+        return (data, True)
+
+    def jpegReadVariable(self, scanner):
+        """Reads the variable-length section the scanner is on. Returns
+        None if it is empty or the file ends first."""
+        length = scanner.variableLength()
+        if length == 0: return None
+        try: return scanner.read(length)
+        except EOFException:
+            self.log("jpegReadVariable: read failed while reading var data");
+            return None
 
-    def collectAdobeParts(self, data):
+    def indexAdobeParts(self, data):
         """Part APP13 contains yet another markup format, one defined by
         Adobe.  See"File Formats Specification" in the Photoshop SDK
-        (avail from www.adobe.com). We must take
-        everything but the IPTC data so that way we can write the file back
-        without losing everything else Photoshop stuffed into the APP13
-        block."""
-        assert isinstance(data, basestring)
+        (avail from www.adobe.com). This walks the resources of the APP13
+        data once and returns a list of (resource id, name, offset,
+        length) tuples, offset and length giving the whole resource
+        (header, name and padding included) in data."""
+        index = []
         length = len(data)
-        offset = 0
-        out = []
         # Skip preamble
         offset = len('Photoshop 3.0 ')
-        # Process everything
-        while offset < length:
-            # Get OSType and ID
-            (ostype, id1, id2) = unpack("!LBB", data[offset:offset+6])
-            offset += 6
-            if offset >= length: break
-
-            # Get pascal string
-            stringlen = unpack("B", data[offset:offset+1])[0]
-            offset += 1
-            if offset >= length: break
-            string = data[offset:offset+stringlen]
-            offset += stringlen
-
-            # round up if odd
-            if (stringlen % 2 != 0): offset += 1
-            # there should be a null if string len is 0
-            if stringlen == 0: offset += 1
-            if offset >= length: break
-
-            # Get variable-size data
-            size = unpack("!L", data[offset:offset+4])[0]
-            offset += 4
-            if offset >= length: break
-
-            var = data[offset:offset+size]
-            offset += size
-            if size % 2 != 0: offset += 1 # round up if odd
-
-            # skip IIM data (0x0404), but write everything else out
-            if not (id1 == 4 and id2 == 4):
-                out.append( pack("!LBB", ostype, id1, id2) )
-                out.append( pack("B", stringlen) )
-                out.append( string )
-                if stringlen == 0 or stringlen % 2 != 0:
-                    out.append( pack("B", 0) )
-                out.append( pack("!L", size) )
-                out.append( var )
-                out = [''.join(out)]
-                if size % 2 != 0 and len(out[0]) % 2 != 0:
-                    out.append( pack("B", 0) )
+        # the smallest resource: OSType, id, empty name and size
+        while offset + 12 <= length:
+            id = unpack_from("!H", data, offset + 4)[0]
+            stringlen = ord(data[offset+6])
+            name = data[offset+7:offset+7+stringlen]
+            # the pascal string is padded to an even length, so a null
+            # follows names of even length (and the empty name)
+            pos = offset + 6 + ((stringlen + 2) & ~1)
+            if pos + 4 > length: break
+            size = unpack_from("!L", data, pos)[0]
+            # the data is padded to an even length too
+            end = min(pos + 4 + size + (size & 1), length)
+            index.append((id, name, offset, end - offset))
+            offset = end
+        return index
 
-        return ''.join(out)
+    def collectAdobeParts(self, data):
+        """Returns all the resources of APP13 data except the IIM data
+        (0x0404), our padding and the dropped ones (see dropResource), so
+        that way we can write the file back without losing everything
+        else Photoshop stuffed into the APP13 block. Kept resources are
+        copied from data as they are."""
+        assert isinstance(data, basestring)
+        if data == self._adobeData: index = self.adobeResources
+        else:
+            index = [r for r in self.indexAdobeParts(data)
+                     if not self._droppedResources.has_key(r[0])]
+        return ''.join([data[offset:offset+length]
+                        for (id, name, offset, length) in index
+                        if id != 0x0404 and id != self.c_padding_id])
+
+    def getResource(self, id):
+        """Returns the data of the first Adobe resource with the given id
+        (e.g. 0x040C for the thumbnail) in the APP13 block of the file,
+        or None."""
+        for (rid, name, offset, length) in self.adobeResources:
+            if rid == id:
+                pos = offset + 6 + ((len(name) + 2) & ~1)
+                size = unpack_from("!L", self._adobeData, pos)[0]
+                return self._adobeData[pos+4:pos+4+size]
+        return None
+
+    def dropResource(self, id):
+        """Removes the Adobe resources with the given id from the APP13
+        block on the next save, e.g. 0x0409 and 0x040C, the thumbnails."""
+        self._droppedResources[id] = True
+        self.adobeResources = [r for r in self.adobeResources if r[0] != id]
+
+    def outCharset(self):
+        """The charset values are written in."""
+        return (self.out_charset is None and [self.inp_charset]
+                or [self.out_charset])[0]
 
     def _enc(self, text):
         """Recodes the given text from the old character set to utf-8"""
-        res = text
-        out_charset = (self.out_charset is None and [self.inp_charset]
-                       or [self.out_charset])[0]
-        if isinstance(text, unicode): res = text.encode(out_charset)
-        elif isinstance(text, str):
-            try: res = unicode(text, encoding=self.inp_charset).encode(out_charset)
-            except:
-                self.log("_enc: charset %s is not working for %s"
-                         % (self.inp_charset, text))
-            res = unicode(text, encoding=self.inp_charset, errors='replace'
-                          ).encode(out_charset)
+        if isinstance(text, basestring):
+            return encodeIIM(text, self.inp_charset, self.outCharset())
         elif isinstance(text, (list, tuple)):
-            res = type(text)(map(self._enc, text))
-        return res
+            return type(text)([self._enc(t) for t in text])
+        return text
+
+    # tag - record - dataset - len (short)
+    c_iim_header = Struct("!BBBH")
+    # record version: tag - record - dataset - len (short) - 4 (short)
+    c_iim_version = pack("!BBBHH", 0x1c, 0x02, 0, 2, 4)
 
     def packedIIMData(self):
         """Assembles and returns our _data and _listdata into IIM format for
         embedding into an image."""
-        out = []
         (tag, record) = (0x1c, 0x02)
-        # Print record version
-        # tag - record - dataset - len (short) - 4 (short)
-        out.append( pack("!BBBHH", tag, record, 0, 2, 4) )
-
-        debug(3, self.hexDump(out))
+        header = self.c_iim_header.pack
+        out = bytearray(self.c_iim_version)
+
+        debug(3, self.hexDump(str(out)))
+        # values read in the output charset and not changed since are
+        # written back as they were
+        inp_charset = self.inp_charset
+        out_charset = self.outCharset()
+        try: sameCharset = (codecs.lookup(inp_charset).name
+                            == codecs.lookup(out_charset).name)
+        except LookupError: sameCharset = False
         # Iterate over data sets
-        for dataset, value in self._data.iteritems():
-            if len(value) == 0: continue
-            if not (c_datasets.has_key(dataset) or isinstance(dataset, int)):
-                self.log("PackedIIMData: illegal dataname '%s' (%d)"
-                                  % (c_datasets[dataset], dataset))
-                continue
-            value = self._enc(value)
-            print value
-            if not isinstance(value, list):
-                value = str(value)
-                out.append( pack("!BBBH", tag, record, dataset, len(value)) )
-                out.append( value )
-            else:
-                for v in map(str, value):
-                    if v is None or len(v) == 0: continue
-                    out.append( pack("!BBBH", tag, record, dataset, len(v)) )
-                    out.append( v )
-
-        return ''.join(out)
-
-    def photoshopIIMBlock(self, otherparts, data):
+        for dataset in self._data.keys():
+            values = sameCharset and self._data.unchanged(dataset)
+            if not values:
+                value = self._data[dataset]
+                if len(value) == 0: continue
+                if not (c_datasets.has_key(dataset) or isinstance(dataset, int)):
+                    self.log("PackedIIMData: illegal dataname '%s' (%d)"
+                                      % (c_datasets[dataset], dataset))
+                    continue
+                if not isinstance(value, list): value = [value]
+                values = []
+                for v in value:
+                    if isinstance(v, basestring):
+                        v = encodeIIM(v, inp_charset, out_charset)
+                    else: v = str(v)
+                    values.append(v)
+            for v in values:
+                if len(v) == 0: continue
+                out += header(tag, record, dataset, len(v))
+                out += v
+
+        return str(out)
+
+    # Plug-in resource id used to pad APP13 blocks, so they can be
+    # rewritten in place. It has an empty name: 12 bytes of header.
+    c_padding_id = 0x1387
+    c_padding_min = 12
+
+    def paddingResource(self, size):
+        """Returns a padding resource exactly size bytes long. size must be
+        even and at least c_padding_min."""
+        assert size % 2 == 0 and size >= self.c_padding_min
+        return ''.join(["8BIM", pack("!HBB", self.c_padding_id, 0, 0),
+                        pack("!L", size - self.c_padding_min),
+                        '\0' * (size - self.c_padding_min)])
+
+    def photoshopIIMBlock(self, otherparts, data, padding=0):
         """Assembles the blob of Photoshop "resource data" that includes our
         fresh IIM data (from PackedIIMData) and the other Adobe parts we
-        found in the file, if there were any."""
+        found in the file, if there were any. If padding is given, a
+        padding resource of about that many bytes is added, as long as
+        the block still fits in a Jpeg segment."""
         out = []
         assert isinstance(data, basestring)
         resourceBlock = ["Photoshop 3.0"]
@@ -1191,6 +2372,10 @@ class IPTCInfo(object):
         # Finally tack on other data
         if otherparts is not None: resourceBlock.append( otherparts )
         resourceBlock = ''.join(resourceBlock)
+        # and the padding, trimmed to what is left of the 64k segment
+        padding = min(padding, 0xffff - 2 - len(resourceBlock)) & ~1
+        if padding >= self.c_padding_min:
+            resourceBlock += self.paddingResource(padding)
 
         out.append( pack("BB", 0xff, 0xed) ) # Jpeg start of block, APP13
         out.append( pack("!H", len(resourceBlock) + 2) ) # length
@@ -1252,6 +2437,225 @@ class IPTCInfo(object):
 
         self._closefh(fh)
 
+#######################################################################
+# Reading many files
+#######################################################################
+
+def _readRecord(path, fields, kwds):
+    """Worker of read_many: (path, {dataset name: value}) or (path, error)."""
+    try:
+        data = IPTCInfo(path, **kwds).data
+        if fields is None:
+            record = dict([(data.keyAsStr(k), v) for (k, v) in data.iteritems()])
+        else: record = dict([(name, data[name]) for name in fields])
+    except Exception, e:
+        return (path, e)
+    return (path, record)
+
+def _readRecords(paths, fields, kwds):
+    return [_readRecord(path, fields, kwds) for path in paths]
+
+def _readChunk(paths, fields, kwds, pickled=False):
+    """Worker of the unordered read_many: _readRecords that never raises,
+    so the pool callback always fires. Returns the records, or the
+    exception raised. With pickled=True (process pools) the records come
+    pickled already, so a result that can't be pickled is caught here
+    too instead of being lost in the pool."""
+    import cPickle
+    try:
+        records = _readRecords(paths, fields, kwds)
+        if pickled: records = cPickle.dumps(records, 2)
+        return records
+    except Exception, e:
+        if pickled:
+            try: cPickle.dumps(e, 2)
+            except Exception: e = RuntimeError(repr(e))
+        return e
+
+def read_many(paths, workers=4, processes=False, ordered=True, window=None,
+              chunksize=16, fields=None, **kwds):
+    """Reads the IPTC data of many files with a pool of workers threads
+    (or processes if processes==True). Yields (path, record) tuples,
+    record being a dict of dataset names and values, or the exception
+    raised for that file. Only the datasets named in fields are decoded,
+    if given. Other keyword arguments go to IPTCInfo, with readonly=True
+    by default.
+
+    Files are handed to the workers chunksize at a time, and at most
+    window chunks (4 * workers by default) are being read or waiting to
+    be yielded at any time, so paths can be a long iterator. If
+    ordered==False, results come as soon as their chunk is ready."""
+    import cPickle
+    import multiprocessing.pool
+    from collections import deque
+    from Queue import Queue
+    kwds.setdefault('readonly', True)
+    if window is None: window = 4 * workers
+    if processes: pool = multiprocessing.pool.Pool(workers)
+    else: pool = multiprocessing.pool.ThreadPool(workers)
+    done = Queue()
+    pending = deque()
+    paths = iter(paths)
+    try:
+        while 1:
+            while len(pending) < window:
+                chunk = [path for (n, path) in zip(xrange(chunksize), paths)]
+                if not chunk: break
+                args = (chunk, fields, kwds)
+                if ordered:
+                    pending.append(pool.apply_async(_readRecords, args))
+                else:
+                    pending.append(chunk)
+                    pool.apply_async(_readChunk, args + (processes,),
+                                     callback=done.put)
+            if not pending: break
+            if ordered: results = pending.popleft().get()
+            else:
+                pending.pop()
+                results = done.get()
+                if isinstance(results, Exception): raise results
+                if processes: results = cPickle.loads(results)
+            for result in results: yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+IPTCInfo.read_many = staticmethod(read_many)
+
+#######################################################################
+# Exporting many files
+#######################################################################
+
+def sqlColumnName(name):
+    """The SQL column of a dataset name: 'province/state' is
+    province_state, 'by-line' by_line."""
+    return re.sub('[^0-9A-Za-z]+', '_', name).strip('_')
+
+def sqlQuote(name):
+    """An SQL identifier quoted for any name: "name", with the double
+    quotes in it doubled."""
+    return '"%s"' % name.replace('"', '""')
+
+# Separator of the values of list datasets (keywords...) in one column
+c_sql_list_sep = u', '
+
+def export_sqlite(paths, database, table='iptc', batch=1000, fields=None,
+                  **kwds):
+    """Reads the IPTC data of many files with read_many (which gets the
+    other keyword arguments) and stores a row per file in table of the
+    SQLite database, a filename or an open sqlite3 connection. The table
+    is created if needed, with a path primary key and a text column per
+    dataset of c_datasets, or per name in fields (the only datasets
+    decoded then); rows of paths already in it are replaced. The table
+    and column names are quoted, so any name is taken literally. Rows are inserted batch at a time with
+    executemany, in one transaction each. Returns the number of rows
+    written and the list of (path, exception) of the files that could
+    not be read."""
+    import sqlite3
+    if fields is None:
+        fields = [c_datasets[k] for k in sorted(c_datasets.keys())]
+    columns = [sqlColumnName(name) for name in fields]
+    if duck_typed(database, 'executemany'): conn = database
+    else: conn = sqlite3.connect(database)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, %s)'
+                     % (sqlQuote(table),
+                        ', '.join(['%s TEXT' % sqlQuote(c) for c in columns])))
+        statement = ('INSERT OR REPLACE INTO %s (path, %s) VALUES (?%s)'
+                     % (sqlQuote(table), ', '.join(map(sqlQuote, columns)),
+                        ', ?' * len(columns)))
+        (rows, written, failed) = ([], 0, [])
+        for (path, record) in read_many(paths, fields=fields, **kwds):
+            if isinstance(record, Exception):
+                failed.append((path, record))
+                continue
+            if isinstance(path, str): path = path.decode(sys_enc, 'replace')
+            row = [path]
+            for name in fields:
+                value = record.get(name)
+                if isinstance(value, (list, tuple)):
+                    value = c_sql_list_sep.join(value) or None
+                row.append(value)
+            rows.append(row)
+            if len(rows) >= batch:
+                conn.executemany(statement, rows)
+                conn.commit()
+                written += len(rows)
+                rows = []
+        if rows:
+            conn.executemany(statement, rows)
+            conn.commit()
+            written += len(rows)
+    finally:
+        if conn is not database: conn.close()
+    return (written, failed)
+
+# XML tags of the list datasets and of their items
+c_xml_lists = {'keywords': ('keywords', 'keyword'),
+               'supplemental category': ('supplemental_categories',
+                                         'supplemental_category'),
+               'contact': ('contacts', 'contact')}
+
+def xmlTagName(name):
+    """The XML tag of a dataset name: spaces become underbars, slashes
+    become dashes."""
+    return re.sub('/', '-', re.sub(' +', '_', name))
+
+def xmlRecord(path, record, basetag='photo'):
+    """The XML element (an utf-8 str) of the record of one file, a dict
+    of dataset names and values as yielded by read_many."""
+    from xml.sax.saxutils import escape, quoteattr
+    E = lambda v: escape(unicode(v))
+    if isinstance(path, str): path = path.decode(sys_enc, 'replace')
+    out = [u'  <%s path=%s>\n' % (basetag, quoteattr(path))]
+    for name in sorted(record.keys()):
+        value = record[name]
+        if isinstance(value, (list, tuple)):
+            if not value: continue
+            (tags, tag) = c_xml_lists.get(name,
+                                          (xmlTagName(name), 'value'))
+            out.append(u'    <%s>\n' % tags)
+            for v in value: out.append(u'      <%s>%s</%s>\n' % (tag, E(v), tag))
+            out.append(u'    </%s>\n' % tags)
+        elif value is not None:
+            tag = xmlTagName(name)
+            out.append(u'    <%s>%s</%s>\n' % (tag, E(value), tag))
+    out.append(u'  </%s>\n' % basetag)
+    return u''.join(out).encode('utf_8')
+
+def jsonRecord(path, record):
+    """The record of one file as a line of JSON (an utf-8 str), with the
+    path under the 'path' key."""
+    import json
+    if isinstance(path, str): path = path.decode(sys_enc, 'replace')
+    record = dict(record)
+    record['path'] = path
+    line = json.dumps(record, ensure_ascii=False, sort_keys=True,
+                      default=unicode)
+    if isinstance(line, unicode): line = line.encode('utf_8')
+    return line + '\n'
+
+def export_records(records, out, format='xml', basetag='photo',
+                   roottag='photos'):
+    """Writes (path, record) tuples, as yielded by read_many, to the file
+    handle out as they come: an XML document with an element per file
+    (see xmlRecord) if format is 'xml', or a line of JSON per file (see
+    jsonRecord) if it is 'jsonl'. Records that are exceptions (files
+    that could not be read) are skipped. Returns the number of records
+    written."""
+    if format not in ('xml', 'jsonl'):
+        raise ValueError('unknown export format %r' % format)
+    n = 0
+    if format == 'xml':
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n<%s>\n' % roottag)
+    for (path, record) in records:
+        if isinstance(record, Exception): continue
+        if format == 'xml': out.write(xmlRecord(path, record, basetag))
+        else: out.write(jsonRecord(path, record))
+        n += 1
+    if format == 'xml': out.write('</%s>\n' % roottag)
+    return n
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         info = IPTCInfo(sys.argv[1])
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''Testes do iptcinfo com imagens do corpus sintético.
+
+Uso: python -m unittest discover -s tests
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'benchmarks'))
+from datetime import datetime
+from struct import unpack
+
+from iptcinfo import IPTCInfo, JpegMarkerScanner, readExif
+
+import corpus
+
+
+def segments(filepath):
+    '''Marcadores dos segmentos do cabeçalho e os bytes a partir do SOS.'''
+    data = open(filepath, 'rb').read()
+    found = []
+    pos = 2
+    while data[pos + 1] != '\xda':
+        found.append(ord(data[pos + 1]))
+        pos += 2 + unpack('!H', data[pos + 2:pos + 4])[0]
+    return found, data[pos:]
+
+
+def body(filepath):
+    '''Bytes da imagem a partir do marcador SOS.'''
+    return segments(filepath)[1]
+
+
+def markers(filepath):
+    '''Marcadores dos segmentos do cabeçalho, até o SOS.'''
+    return segments(filepath)[0]
+
+
+class SaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, 'foto.jpg')
+        with open(self.filepath, 'wb') as fh:
+            fh.write(corpus.jpeg(random.Random(1), 200000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def edit(self, caption):
+        info = IPTCInfo(self.filepath, force=True)
+        info.data['caption/abstract'] = caption
+        return info
+
+    def test_save_in_place(self):
+        '''O save() padrão reescreve só o APP13 quando os dados cabem.'''
+        # A primeira gravação reescreve o arquivo e reserva espaço no APP13
+        self.assertTrue(self.edit(u'primeira legenda').save())
+        before = os.stat(self.filepath)
+        image = body(self.filepath)
+
+        self.assertTrue(self.edit(u'segunda legenda, um pouco maior').save())
+        after = os.stat(self.filepath)
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(before.st_size, after.st_size)
+        self.assertEqual(image, body(self.filepath))
+        self.assertFalse(os.path.exists(self.filepath + '~'))
+        self.assertEqual(IPTCInfo(self.filepath).data['caption/abstract'],
+                u'segunda legenda, um pouco maior')
+
+
+class ReadOnlyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, 'foto.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self, app_segments):
+        with open(self.filepath, 'wb') as fh:
+            fh.write(corpus.jpeg(random.Random(1), 200000,
+                app_segments=app_segments))
+        info = IPTCInfo(self.filepath, force=True, readonly=True, exif=True,
+                imageinfo=True)
+        self.assertTrue(info.data['keywords'])
+        self.assertTrue(info.exif)
+        self.assertTrue(info.imageInfo)
+        return info
+
+    def test_one_read(self):
+        '''Um cabeçalho comum sai de uma só leitura.'''
+        info = self.read(0)
+        self.assertEqual(info.readCalls, 1)
+        self.assertEqual(info.bytesRead, JpegMarkerScanner.CHUNK)
+
+    def test_long_header(self):
+        '''Um cabeçalho maior que a primeira leitura pede só mais uma.'''
+        info = self.read(18)
+        header = os.path.getsize(self.filepath) - len(body(self.filepath))
+        self.assertTrue(JpegMarkerScanner.CHUNK < header <
+                2 * JpegMarkerScanner.CHUNK)
+        self.assertEqual(info.readCalls, 2)
+
+
+class ExifTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, 'foto.jpg')
+        with open(self.filepath, 'wb') as fh:
+            fh.write(corpus.jpeg(random.Random(1), 20000, app_segments=2,
+                exif_app1=False))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def save_new_exif(self, options=None):
+        date = datetime(2012, 3, 4, 5, 6, 7)
+        info = IPTCInfo(self.filepath, force=True)
+        info.setExif('Exif.Photo.DateTimeOriginal', date)
+        self.assertTrue(info.save(options))
+        self.assertEqual(readExif(self.filepath)[
+            'Exif.Photo.DateTimeOriginal'], date)
+
+    def test_new_exif_after_app0(self):
+        '''O APP1 novo vai logo depois do APP0.'''
+        self.save_new_exif()
+        self.assertEqual(markers(self.filepath)[:2], [0xe0, 0xe1])
+
+    def test_new_exif_discard_app_parts(self):
+        '''Com discardAppParts o APP1 novo vai depois do APP0 refeito.'''
+        # Sem APP0: o iptcinfo põe um no lugar dos segmentos descartados
+        data = open(self.filepath, 'rb').read()
+        self.assertEqual(markers(self.filepath)[0], 0xe0)
+        with open(self.filepath, 'wb') as fh:
+            fh.write(data[:2] + data[4 + unpack('!H', data[4:6])[0]:])
+        self.save_new_exif({'discardAppParts': 'on'})
+        found = markers(self.filepath)
+        self.assertEqual(found[:2], [0xe0, 0xe1])
+        self.assertFalse(set(found[2:]) & set([0xe2, 0xee]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,22 +22,35 @@ import logging
 import operator
 import os
 import pickle
-import pyexiv2  # Versão 0.3.0
 import re
 import sys
 import subprocess
 import time
 from datetime import datetime
+from fnmatch import fnmatch
+from fractions import Fraction
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 from PIL import Image
+from Queue import Queue
 from shutil import copy
+from stat import S_ISDIR, S_ISLNK
+from threading import Lock
 from urllib import urlretrieve
 
+try:
+    # os.scandir só existe no Python 3.5; no 2.7 precisa do pacote scandir
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from PyQt4.QtWebKit import *
 
 from mendeley import Mendeley  # Referências
-from iptcinfo import IPTCInfo  # iptcinfo.py
+from iptcinfo import IPTCInfo, readExif, gpsInfo, c_exif_gps, c_exif_dates, \
+        SKIPPED, export_records
 
 # Gerado com: pyrcc4 -o recursos.py recursos.qrc
 import recursos
@@ -65,8 +78,11 @@ class MainWindow(QMainWindow):
         #XXX Global pela facilidade de acesso. Melhorar eventualmente.
         global mainWidget
         global options
+        # Identidade dos arquivos pelo conteúdo, que também indexa a tabela
+        self.fingerprints = Fingerprints(fingerprints)
         mainWidget = MainTable(self, datalist, header)
         self.model = mainWidget.model
+        self.model.identify = self.fingerprints.cached
         self.automodels = AutoModels(autolists)
         options = PrefsDialog(self)
         self.help = ManualDialog(self)
@@ -109,6 +125,18 @@ class MainWindow(QMainWindow):
         # Live editing
         self.live_edit = None
 
+        # Importação em segundo plano (ImportThread)
+        self.importer = None
+        # Manifesto dos arquivos importados: caminho -> filesig
+        self.manifest = manifest
+        # Busca de imagens nas pastas
+        self.finder = FileFinder()
+        # Impressões dos arquivos gravados, recalculadas numa FingerprintThread
+        self.refresher = None
+        self.refresh_todo = []
+        # Pastas vigiadas, com importação automática (FolderWatcher)
+        self.watcher = FolderWatcher(self)
+
         # Atribuições da MainWindow
         self.setCentralWidget(mainWidget)
         self.setWindowTitle(u'Véliger - Editor de Metadados')
@@ -161,6 +189,20 @@ class MainWindow(QMainWindow):
         self.delRow.setStatusTip(u'Deletar entrada')
         self.connect(self.delRow, SIGNAL('triggered()'), self.delcurrent)
 
+        # Vigiar pasta
+        self.watchDir = QAction(QIcon(u':/pasta.png'),
+                u'Vigiar pasta', self)
+        self.watchDir.setStatusTip(
+                u'Importar automaticamente as imagens que chegarem na pasta')
+        self.connect(self.watchDir, SIGNAL('triggered()'),
+                self.watchdir_dialog)
+
+        # Parar de vigiar pasta
+        self.unwatchDir = QAction(u'Parar de vigiar pasta', self)
+        self.unwatchDir.setStatusTip(u'Remover uma das pastas vigiadas')
+        self.connect(self.unwatchDir, SIGNAL('triggered()'),
+                self.unwatchdir_dialog)
+
         # Gravar metadados nas imagens
         self.writeMeta = QAction(QIcon(u':/salvar.png'),
                 u'Gravar metadados', self)
@@ -172,6 +214,13 @@ class MainWindow(QMainWindow):
                 u'Metadados gravados na(s) imagem(ns)')
         self.writeMeta.triggered.connect(salvo)
 
+        # Exportar catálogo
+        self.exportCatalog = QAction(u'Exportar catálogo', self)
+        self.exportCatalog.setStatusTip(
+                u'Exportar metadados da tabela em XML ou JSON')
+        self.connect(self.exportCatalog, SIGNAL('triggered()'),
+                self.exportcatalog)
+
         # Limpar tabela
         self.delAll = QAction(QIcon(u':/deletar.png'),
                 u'Limpar tabela', self)
@@ -235,8 +284,11 @@ class MainWindow(QMainWindow):
         self.arquivo = self.menubar.addMenu(u'&Arquivo')
         self.arquivo.addAction(self.openFile)
         self.arquivo.addAction(self.openDir)
+        self.arquivo.addAction(self.watchDir)
+        self.arquivo.addAction(self.unwatchDir)
         self.arquivo.addSeparator()
         self.arquivo.addAction(self.writeMeta)
+        self.arquivo.addAction(self.exportCatalog)
         self.arquivo.addSeparator()
         self.arquivo.addAction(self.exit)
 
@@ -306,6 +358,11 @@ class MainWindow(QMainWindow):
                 SIGNAL('refSync(PyQt_PyObject)'),
                 self.sync_refs)
 
+        # Mensagens de status vindas de outras threads
+        self.connect(self,
+                SIGNAL('statusChanged(PyQt_PyObject, int)'),
+                self.changeStatus)
+
         # Live update
         self.connect(self.timer,
                 SIGNAL('timeout()'),
@@ -316,6 +373,11 @@ class MainWindow(QMainWindow):
                 SIGNAL('customContextMenuRequested(QPoint)'),
                 self.rightclick)
 
+        # Importa o que chegou nas pastas vigiadas com o programa fechado,
+        # depois das conexões para as mensagens de status chegarem
+        if self.watcher.folders:
+            self.startimport(folders=self.watcher.folders, progress=False)
+
     def rightclick(self, position):
         '''Identifica quem está sendo editado.'''
         self.rightmenu.popup(mainWidget.mapToGlobal(position))
@@ -674,11 +736,14 @@ class MainWindow(QMainWindow):
                 for entry in self.model.mydata:
                     entries.append(entry[0])
                 self.cleartable()
-            for filepath in entries:
-                entrymeta = self.createmeta(filepath, 'latin-1')
-                self.model.insert_rows(0, 1, QModelIndex(), entrymeta)
-                self.writemeta(entrymeta)
-                n_all += 1
+            # Insere na tabela em lotes, não uma entrada por vez
+            for start in xrange(0, len(entries), ImportThread.batch):
+                chunk = [self.createmeta(filepath, 'latin-1') for filepath in
+                        entries[start:start + ImportThread.batch]]
+                self.model.insert_entries(chunk)
+                for entrymeta in chunk:
+                    self.writemeta(entrymeta)
+                    n_all += 1
             self.changeStatus(
                     u'Metadados de %d figuras convertidos para UTF-8'
                     % n_all)
@@ -708,9 +773,7 @@ class MainWindow(QMainWindow):
         correspondente na tabela principal. Se o item não for encontrado o item
         na lista é apagado.
         '''
-        index = self.model.index(0, 0, QModelIndex())
-        matches = self.model.match(index, 0, filename, -1,
-                Qt.MatchContains)
+        matches = self.matchfinder(filename)
         if len(matches) == 1:
             match = matches[0]
             mainWidget.selectRow(match.row())
@@ -737,9 +800,9 @@ class MainWindow(QMainWindow):
         entries = self.dockUnsaved.mylist
         if entries:
             for entry in entries:
-                index = self.model.index(0, 0, QModelIndex())
-                matches = self.model.match(index, 0, entry, -1,
-                        Qt.MatchContains)
+                # Pela identidade; o caminho se ela mudou (já gravada)
+                matches = self.matchfinder(self.dockUnsaved.keys.get(entry,
+                    entry)) or self.matchfinder(entry)
                 if len(matches) == 1:
                     values = []
                     match = matches[0]
@@ -754,9 +817,13 @@ class MainWindow(QMainWindow):
                         self.changeStatus(u'%s atualizado!' % filename)
                         logger.debug('Metadados gravados em %s!', filename)
                         continue
+                    elif write == SKIPPED:
+                        self.changeStatus(u'%s sem alterações' % filename)
+                        logger.debug('%s sem alterações, não regravado', filename)
+                        continue
                     else:
                         break
-            if write == 0:
+            if write == 0 or write == SKIPPED:
                 mainWidget.emitsaved()
             else:
                 self.changeStatus(u'%s deu erro!' % filename, 5000)
@@ -773,8 +840,8 @@ class MainWindow(QMainWindow):
                 critical.setIcon(QMessageBox.Critical)
                 critical.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
                 critical.exec_()
-                self.setselection(filename)
-                mainWidget.emitlost(filename)
+                self.setselection(entry)
+                mainWidget.emitlost(entry)
                 if critical == QMessageBox.Yes:
                     self.delcurrent()
         else:
@@ -784,11 +851,10 @@ class MainWindow(QMainWindow):
         '''Grava os metadados no arquivo.
 
         Valores são salvos de acordo com os respectivos padrões, IPTC e EXIF.
+        Retorna 0 se gravou ou SKIPPED se a imagem já tinha estes metadados e
+        não foi modificada.
         '''
-        video_extensions = ('avi', 'AVI', 'mov', 'MOV', 'mp4', 'MP4', 'ogg',
-                'OGG', 'ogv', 'OGV', 'dv', 'DV', 'mpg', 'MPG', 'mpeg', 'MPEG',
-                'flv', 'FLV', 'm2ts', 'M2TS', 'wmv', 'WMV')
-        if values[0].endswith(video_extensions):
+        if fileext(values[0]) in FileFinder.videos:
             try:
                 text_name = os.path.basename(values[0])
                 new_name = text_name.split('.')[0] + '.txt'
@@ -844,7 +910,8 @@ class MainWindow(QMainWindow):
 
         else:
             # Criar objeto com metadados
-            info = IPTCInfo(values[0], force=True, inp_charset='utf-8')
+            # Exif lido junto, para não regravar tags que não mudaram
+            info = IPTCInfo(values[0], force=True, inp_charset='utf-8', exif=True)
             try:
                 info.data['object name'] = values[1]                     # title
                 info.data['caption/abstract'] = self.put_dot(values[2])  # caption
@@ -867,67 +934,57 @@ class MainWindow(QMainWindow):
                     keywords = [keyword.lower().strip() for keyword in keywords if
                             keyword.strip() != '']
                     info.data['keywords'] = list(set(keywords))         # keywords
-                info.save()
 
-                # Exif
-                logger.info('Gravando EXIF de %s...', values[0])
+                # Exif, gravado junto com o IPTC num único info.save()
                 lat = values[13]
                 long = values[14]
-                image = self.dockGeo.get_exif(values[0])
                 if lat and long:
-                    newgps = self.dockGeo.geodict(lat, long)
-                    self.changeStatus(u'Gravando novas coordenadas de %s...' %
-                            values[0])
                     try:
-                        image['Exif.GPSInfo.GPSLatitudeRef'] = str(newgps['latref'])
-                        image['Exif.GPSInfo.GPSLatitude'] = (
-                                newgps['latdeg'], newgps['latmin'], newgps['latsec'])
-                        image['Exif.GPSInfo.GPSLongitudeRef'] = str(newgps['longref'])
-                        image['Exif.GPSInfo.GPSLongitude'] = (
-                                newgps['longdeg'], newgps['longmin'], newgps['longsec'])
-                        image.write()
-                        self.changeStatus(u'Gravando novas coordenadas de %s... pronto!' % values[0], 5000)
-                        logger.debug('EXIF gravado em %s', values[0])
+                        newgps = self.dockGeo.geodict(lat, long)
+                        info.setExif('Exif.GPSInfo.GPSLatitudeRef', str(newgps['latref']))
+                        info.setExif('Exif.GPSInfo.GPSLatitude', (
+                                newgps['latdeg'], newgps['latmin'], newgps['latsec']))
+                        info.setExif('Exif.GPSInfo.GPSLongitudeRef', str(newgps['longref']))
+                        info.setExif('Exif.GPSInfo.GPSLongitude', (
+                                newgps['longdeg'], newgps['longmin'], newgps['longsec']))
+                        logger.debug('Novas coordenadas de %s: %s %s', values[0], lat, long)
                     except:
-                        self.changeStatus(u'Gravando novas coordenadas de %s... ERRO OCORREU!' % values[0], 5000)
-                        logger.warning('Erro na gravação das coordenadas em %s...', values[0])
+                        self.changeStatus(u'Coordenadas de %s inválidas, não serão gravadas!' % values[0], 5000)
+                        logger.warning('Erro nas coordenadas de %s...', values[0])
                 else:
-                    try:
-                        self.changeStatus(u'Deletando o campo Exif.GPSInfo de %s...' % values[0])
-                        image.__delitem__('Exif.GPSInfo.GPSLatitudeRef')
-                        image.__delitem__('Exif.GPSInfo.GPSLatitude')
-                        image.__delitem__('Exif.GPSInfo.GPSLongitudeRef')
-                        image.__delitem__('Exif.GPSInfo.GPSLongitude')
-                        image.write()
-                        self.changeStatus(u'Deletando o campo Exif.GPSInfo de %s... pronto!' % values[0], 5000)
-                        logger.debug('Campo Exif.GPSInfo de %s deletado!', values[0])
-                    except:
-                        self.changeStatus(u'Deletando o campo Exif.GPSInfo de %s... ERRO!' % values[0], 5000)
-                        logger.debug('Erro para deletar Exif.GPSInfo de %s', values[0])
+                    logger.debug('Deletando o campo Exif.GPSInfo de %s', values[0])
+                    for key in c_exif_gps:
+                        info.delExif(key)
 
                 # Data da criação da imagem
-                if values[15]:
-                    try:
+                try:
+                    if values[15]:
                         newdate = datetime.strptime(values[15], '%Y-%m-%d %H:%M:%S')
-                        image['Exif.Photo.DateTimeOriginal'] = newdate
-                        image['Exif.Photo.DateTimeDigitized'] = newdate
-                        image.write()
-                    except:
-                        logger.debug('Erro para gravar data de %s.', values[0])
-                else:
-                    try:
+                    else:
                         #TODO Decidir o que fazer aqui... deletar ou passar?
                         # Se nenhum valor estiver definido salvar padrão.
-                        default_date = datetime(1900, 01, 01, 00, 00, 00)
-                        image['Exif.Photo.DateTimeOriginal'] = default_date
-                        image['Exif.Photo.DateTimeDigitized'] = default_date
-                        #print 'Deletando datas de origem...'
-                        #image.__delitem__('Exif.Photo.DateTimeOriginal')
-                        #image.__delitem__('Exif.Photo.DateTimeDigitized')
-                        #print image['Exif.Image.DateTime']
-                        image.write()
-                    except:
-                        logger.debug('Erro para gravar data de %s.', values[0])
+                        newdate = datetime(1900, 01, 01, 00, 00, 00)
+                    info.setExif('Exif.Photo.DateTimeOriginal', newdate)
+                    info.setExif('Exif.Photo.DateTimeDigitized', newdate)
+                except:
+                    logger.debug('Erro para gravar data de %s.', values[0])
+
+                logger.info('Gravando IPTC e EXIF de %s...', values[0])
+                # Só as linhas da tabela têm thumbnail
+                intable = bool(self.model.find_rows(values[0]))
+                oldthumb = self.thumbpath(values[0])
+                saved = info.save()
+                if saved == SKIPPED:
+                    logger.debug('%s já tinha estes metadados', values[0])
+                else:
+                    logger.debug('Metadados gravados em %s', values[0])
+                    # A gravação não é uma mudança a ser reimportada
+                    if values[0] in self.manifest:
+                        self.manifest[values[0]] = filesig(values[0])
+                    # O conteúdo mudou, e com ele a impressão e o nome do
+                    # thumbnail, calculados fora da thread da interface
+                    if intable and self.fingerprints.cached(values[0]):
+                        self.refreshfingerprints([(values[0], oldthumb)])
 
             except:
                 logger.warning('Ocorreu algum erro.')
@@ -940,11 +997,82 @@ class MainWindow(QMainWindow):
             else:
                 # Salva cache
                 self.cachetable()
+                if saved == SKIPPED:
+                    return SKIPPED
                 return 0
 
+    # Colunas da tabela principal e nomes dos campos no catálogo exportado
+    catalog_fields = [
+            (1, 'object name'),
+            (2, 'caption/abstract'),
+            (3, 'keywords'),
+            (4, 'headline'),
+            (5, 'source'),
+            (6, 'by-line'),
+            (7, 'copyright notice'),
+            (8, 'special instructions'),
+            (9, 'sub-location'),
+            (10, 'city'),
+            (11, 'province/state'),
+            (12, 'country/primary location name'),
+            (13, 'latitude'),
+            (14, 'longitude'),
+            (15, 'date'),
+            (17, 'credit'),
+            ]
+
+    def catalogrecords(self):
+        '''Gera os registros (caminho, metadados) das linhas da tabela.
+
+        Mesmo formato do iptcinfo.read_many, para ser usado com
+        export_records. Marcadores viram uma lista.
+        '''
+        for row in self.model.mydata:
+            if not row[0]:
+                continue
+            record = {}
+            for col, name in self.catalog_fields:
+                record[name] = row[col]
+            record['keywords'] = [keyword.strip() for keyword in
+                    row[3].split(',') if keyword.strip() != '']
+            yield row[0], record
+
+    def exportcatalog(self):
+        '''Exporta os metadados da tabela para um arquivo XML ou JSON.
+
+        Cada entrada é escrita no arquivo assim que é lida, sem montar o
+        catálogo inteiro na memória.
+        '''
+        filepath = QFileDialog.getSaveFileName(self,
+                u'Exportar catálogo', self.last_opendir,
+                u'XML (*.xml);;JSON, um registro por linha (*.jsonl)')
+        if not filepath:
+            return
+        filepath = unicode(filepath)
+        if filepath.endswith('.jsonl') or filepath.endswith('.json'):
+            format = 'jsonl'
+        else:
+            format = 'xml'
+        catalog = open(filepath, 'wb')
+        try:
+            n_all = export_records(self.catalogrecords(), catalog, format)
+        finally:
+            catalog.close()
+        self.changeStatus(u'%d entradas exportadas para %s' % (n_all,
+            filepath), 10000)
+        logger.debug('%d entradas exportadas para %s', n_all, filepath)
+
     def changeStatus(self, status, duration=2000):
-        '''Muda a mensagem de status da janela principal.'''
-        self.statusBar().showMessage(status, duration)
+        '''Muda a mensagem de status da janela principal.
+
+        Pode ser chamada pelas threads da importação; nesse caso a mensagem é
+        repassada por sinal para a thread da interface.
+        '''
+        if QThread.currentThread() != self.thread():
+            self.emit(SIGNAL('statusChanged(PyQt_PyObject, int)'), status,
+                    duration)
+        else:
+            self.statusBar().showMessage(status, duration)
 
     def openfile_dialog(self):
         '''Abre janela para escolher arquivos.
@@ -960,31 +1088,9 @@ class MainWindow(QMainWindow):
                 self.last_openfile, u'Imagens (*.jpg *.jpeg *.JPG *.JPEG);;Vídeos (*.avi *.AVI *.mov *.MOV *.mp4 *.MP4 *.ogg *.OGG *.ogv *.OGV *.dv *.DV *.mpg *.MPG *.mpeg *MPEG *.flv *.FLV *.wmv *.WMV *.m2ts *.M2TS')
         if filepaths:
             self.last_openfile = os.path.dirname(unicode(filepaths[0]))
-            n_all = len(filepaths)
-            n_new = 0
-            n_dup = 0
-            t0 = time.time()
-            self.changeStatus(u'Importando %d imagens...' % n_all)
-            for filepath in filepaths:
-                filename = os.path.basename(unicode(filepath))
-                matches = self.matchfinder(filename)
-                if len(matches) == 0:
-                    entrymeta = self.createmeta(filepath)
-                    self.model.insert_rows(0, 1, QModelIndex(), entrymeta)
-                    n_new += 1
-                    logger.info('%s foi importada.', filepath)
-                else:
-                    n_dup += 1
-                    logger.info('%s é duplicada.', filepath)
-                    pass
-            t1 = time.time()
-            t = t1 - t0
-            self.changeStatus(u'%d imagens analisadas em %.2f s,' % (n_all, t) +
-                    u' %d novas e %d duplicadas' % (n_new, n_dup), 10000)
-            logger.info('%d imagens analisadas em %.2f s', n_all, t)
-            logger.info('%d novas e %d duplicadas', n_new, n_dup)
-        # Salva cache
-        self.cachetable()
+            self.changeStatus(u'Importando %d imagens...' % len(filepaths))
+            self.startimport(filepaths=[unicode(filepath) for filepath in
+                filepaths])
 
     def opendir_dialog(self):
         '''Abre janela para selecionar uma pasta.
@@ -1003,84 +1109,197 @@ class MainWindow(QMainWindow):
             self.last_opendir = unicode(folder)
             self.imgfinder(unicode(folder))
 
-    def imgfinder(self, folder, apply_only=False):
-        '''Busca recursivamente imagens na pasta selecionada.
+    def watchdir_dialog(self):
+        '''Escolhe uma pasta para vigiar e importa as imagens dela.
 
-        É possível definir as extensões a serem procuradas. Quando um arquivo é
-        encontrado ele verifica se já está na tabela. Se não estiver, ele chama
-        a função para extrair os metadados e insere uma nova entrada.
+        Depois da primeira importação só os arquivos novos ou modificados
+        na pasta são importados (veja FolderWatcher).
         '''
-        n_all = 0
-        n_new = 0
-        n_dup = 0
+        folder = QFileDialog.getExistingDirectory(self,
+                'Selecione uma pasta para vigiar', self.last_opendir,
+                QFileDialog.ShowDirsOnly)
+        if not folder:
+            return
+        folder = unicode(folder)
+        if not self.watcher.add(folder):
+            self.changeStatus(u'A pasta %s já está sendo vigiada' % folder)
+            return
+        self.changeStatus(u'Vigiando %s' % folder)
+        self.startimport(folders=[folder])
+
+    def unwatchdir_dialog(self):
+        '''Escolhe uma das pastas vigiadas para deixar de vigiar.'''
+        if not self.watcher.folders:
+            self.changeStatus(u'Nenhuma pasta está sendo vigiada')
+            return
+        folder, ok = QInputDialog.getItem(self, u'Parar de vigiar pasta',
+                u'Pasta:', self.watcher.folders, 0, False)
+        if ok:
+            self.watcher.remove(unicode(folder))
+            self.changeStatus(u'A pasta %s não está mais sendo vigiada' %
+                    folder)
 
-        applylist = []
+    def imgfinder(self, folder, apply_only=False):
+        '''Busca recursivamente imagens na pasta selecionada.
 
-        # Tupla para o endswith()
-        extensions = (
-            'jpg', 'JPG', 'jpeg', 'JPEG', 'avi', 'AVI', 'mov',
-            'MOV', 'mp4', 'MP4', 'ogg', 'OGG', 'ogv', 'OGV',
-            'dv', 'DV', 'mpg', 'MPG', 'mpeg', 'MPEG', 'flv',
-            'FLV', 'm2ts', 'M2TS', 'wmv', 'WMV'
-            )
+        A busca é feita pelo FileFinder. A leitura dos metadados e a criação
+        dos thumbnails das imagens que não estão na tabela são feitas em
+        segundo plano (veja startimport). Com apply_only=True apenas retorna
+        a lista de arquivos encontrados.
+        '''
+        if not apply_only:
+            self.startimport(folders=[folder])
+            return
+        logger.info('Buscando imagens em %s', folder)
+        return [filepath for filepath, st in self.finder.walk([folder])]
 
-        t0 = time.time()
+    def startimport(self, filepaths=(), folders=(), progress=True):
+        '''Importa arquivos e pastas numa ImportThread.
 
-        logger.info('Buscando imagens em %s', folder)
-        # Buscador de imagens em ação
-        for root, dirs, files in os.walk(folder):
-            for filename in files:
-                if filename.endswith(extensions):
-                    filepath = os.path.join(root, filename)
-                    if not apply_only:
-                        matches = self.matchfinder(filename)
-                        if len(matches) == 0:
-                            entrymeta = self.createmeta(filepath)
-                            self.model.insert_rows(0, 1, QModelIndex(), entrymeta)
-                            n_new += 1
-                            logger.info('%s foi importada.', filepath)
-                        else:
-                            n_dup += 1
-                            logger.info('%s é duplicada.', filepath)
-                            pass
-                        n_all += 1
-                    else:
-                        applylist.append(filepath)
-
-        else:  # Se o número máximo de imagens for atingido, finalizar.
-            if not apply_only:
-                t1 = time.time()
-                t = t1 - t0
-                self.changeStatus(u'%d imagens analisadas em %.2f s,' % (n_all, t) +
-                        u' %d novas e %d duplicadas' % (n_new, n_dup), 10000)
-                logger.info('%d imagens analisadas em %.2f s', n_all, t)
-                logger.info('%d novas e %d duplicadas', n_new, n_dup)
-        if apply_only:
-            return applylist
+        Mostra uma barra de progresso com velocidade, tempo restante e botão
+        para cancelar; com progress=False (importação das pastas vigiadas)
+        o progresso vai só para a barra de status. As entradas chegam em
+        lotes e são inseridas na tabela pela thread da interface.
+        '''
+        if self.importer is not None and self.importer.isRunning():
+            self.changeStatus(u'Espere a importação em andamento terminar',
+                    5000)
+            return
+        self.importer = ImportThread(self, filepaths, folders,
+                self.model.filepaths(), self.manifest)
+        self.import_todo = 0
+        self.import_kept = []
+        self.importprogress = None
+        if progress:
+            self.importprogress = QProgressDialog(u'Procurando imagens...',
+                    u'Cancelar', 0, 0, self)
+            self.importprogress.setWindowTitle(u'Importando imagens')
+            self.importprogress.setWindowModality(Qt.WindowModal)
+            self.importprogress.setMinimumDuration(500)
+            self.connect(self.importprogress, SIGNAL('canceled()'),
+                    self.importer.cancel)
+        self.connect(self.importer, SIGNAL('found(int)'),
+                self.importfound)
+        self.connect(self.importer, SIGNAL('imported(PyQt_PyObject)'),
+                self.importbatch)
+        self.connect(self.importer, SIGNAL('progress(int)'),
+                self.importstep)
+        self.connect(self.importer, SIGNAL('finished()'),
+                self.importfinished)
+        self.import_t0 = time.time()
+        self.importer.start()
+
+    def importfound(self, n_todo):
+        '''Fim da busca: n_todo imagens novas para importar.'''
+        self.import_todo = n_todo
+        if self.importprogress is None:
+            return
+        self.importprogress.setMaximum(n_todo)
+        self.importprogress.setLabelText(u'Importando %d imagens...' % n_todo)
+
+    def importbatch(self, entries):
+        '''Insere na tabela um lote de entradas importadas.
+
+        Entradas de arquivos que já estão na tabela (modificados) substituem
+        a linha antiga, menos as que têm edições não gravadas (na lista do
+        dockUnsaved): estas ficam como estão e vão para import_kept.
+        '''
+        new = []
+        for entrymeta in entries:
+            filepath = unicode(entrymeta[0])
+            if self.model.find_rows(filepath) and \
+                    self.dockUnsaved.findentry(filepath) is not None:
+                self.import_kept.append(filepath)
+                logger.warning('%s mudou, mas tem edições não gravadas',
+                        filepath)
+            elif not self.model.update_entry(entrymeta):
+                new.append(entrymeta)
+        self.model.insert_entries(new)
+
+    def importstep(self, n_done):
+        '''Atualiza a barra de progresso com velocidade e tempo restante.'''
+        n_todo = self.import_todo
+        elapsed = time.time() - self.import_t0
+        rate = n_done / max(elapsed, 0.001)
+        remaining = (n_todo - n_done) / max(rate, 0.001)
+        label = u'%d de %d imagens, %.1f imagens/s, faltam %d s' % (n_done,
+                n_todo, rate, remaining)
+        if self.importprogress is None:
+            self.changeStatus(u'Importando: ' + label)
+            return
+        self.importprogress.setValue(n_done)
+        self.importprogress.setLabelText(label)
+
+    def importfinished(self):
+        '''Fecha a barra de progresso e mostra o resumo da importação.'''
+        if self.importprogress is not None:
+            self.importprogress.reset()
+        importer = self.importer
+        # As linhas mantidas continuam com a assinatura antiga, para serem
+        # reimportadas depois de gravadas ou descartadas as edições
+        for filepath in self.import_kept:
+            if filepath in self.manifest:
+                importer.manifest[filepath] = self.manifest[filepath]
+            else:
+                importer.manifest.pop(filepath, None)
+        self.manifest = importer.manifest
+        n_all = importer.n_new + importer.n_dup + importer.n_changed + \
+                importer.n_same + importer.n_error
+        t = time.time() - self.import_t0
+        status = u'%d imagens analisadas em %.2f s,' % (n_all, t) + \
+                u' %d novas e %d duplicadas' % (importer.n_new, importer.n_dup)
+        if importer.n_changed or importer.n_same:
+            status += u', %d modificadas e %d sem mudanças' % (
+                    importer.n_changed, importer.n_same)
+        if importer.n_deleted:
+            status += u', %d apagadas' % importer.n_deleted
+        if self.import_kept:
+            status += u', %d modificadas mantidas por terem edições não' \
+                    u' gravadas' % len(self.import_kept)
+        if importer.failed:
+            status += u', %d pastas não puderam ser lidas' % \
+                    len(importer.failed)
+        if importer.n_error:
+            status += u', %d com erro' % importer.n_error
+        if importer.cancelled:
+            status += u' (cancelada)'
+        self.changeStatus(status, 10000)
+        logger.info('%d imagens analisadas em %.2f s', n_all, t)
+        logger.info('%d novas e %d duplicadas', importer.n_new, importer.n_dup)
+        logger.info('%d modificadas, %d sem mudanças e %d apagadas',
+                importer.n_changed, importer.n_same, importer.n_deleted)
         # Salva cache
         self.cachetable()
 
     def createmeta(self, filepath, charset='utf-8'):
         '''Define as variáveis extraídas dos metadados (IPTC e EXIF) da imagem.
 
-        Usa a biblioteca do arquivo iptcinfo.py e pyexiv. Retorna lista com
-        valores.
+        Usa a biblioteca do arquivo iptcinfo.py, que lê o IPTC e o EXIF numa
+        só passada pelo cabeçalho. Retorna lista com valores. Roda nas
+        threads da ImportThread: não mexe em widgets, só manda mensagens
+        pelo changeStatus.
         '''
         filepath = unicode(filepath)
         filename = os.path.basename(filepath)
         self.changeStatus(u'Lendo os metadados de %s e criando variáveis...' % filename)
         logger.info('Lendo metadados de %s...', filename)
-        # Extensões
-        photo_extensions = ('jpg', 'JPG', 'jpeg', 'JPEG')
-        video_extensions = ('avi', 'AVI', 'mov', 'MOV', 'mp4', 'MP4', 'ogg', 'OGG', 'ogv', 'OGV', 'dv', 'DV', 'mpg', 'MPG', 'mpeg', 'MPEG', 'flv', 'FLV', 'm2ts', 'M2TS', 'wmv', 'WMV')
+        # Extensão em minúsculas, veja FileFinder
+        extension = fileext(filename)
 
         meta = {}
 
-        if filename.endswith(photo_extensions):
+        if extension in FileFinder.photos:
             type = 'photo'
             # Criar objeto com metadados
             # force=True permite editar imagem sem IPTC
-            info = IPTCInfo(filepath, force=True, inp_charset=charset)
+            # readonly=True lê apenas o cabeçalho, até o marcador 0xDA
+            # exif=True extrai GPS e datas do EXIF na mesma leitura
+            # imageinfo=True guarda tamanho e orientação para o thumbnail
+            info = IPTCInfo(filepath, force=True, inp_charset=charset,
+                    readonly=True, exif=True, imageinfo=True)
+            imageinfo = info.imageInfo
+            logger.debug('%d bytes lidos de %s em %d leituras.',
+                    info.bytesRead, filename, info.readCalls)
             # Checando se o arquivo tem dados IPTC
             if len(info.data) < 4:
                 logger.debug('%s não tem dados IPTC!', filename)
@@ -1104,13 +1323,12 @@ class MainWindow(QMainWindow):
                     }
 
             # Extraindo GPS
-            exif = self.dockGeo.get_exif(filepath)
-            gps = self.dockGeo.get_gps(exif)
+            gps = exifgps(info.exif)
             # Testa a integridade do GPS do EXIF olhando o latref.
             # Se estiver ok, continua. Talvez precise melhorar.
             if gps:
                 if gps['latref']:
-                    gps_str = self.dockGeo.gps_string(gps)
+                    gps_str = gpsstring(gps)
                     meta['latitude'] = gps_str['lat']
                     meta['longitude'] = gps_str['long']
                     logger.debug('GPS íntegro.')
@@ -1120,7 +1338,7 @@ class MainWindow(QMainWindow):
                 meta['latitude'], meta['longitude'] = '', ''
 
             # Extraindo data de criação da foto
-            datedate = self.dockGeo.get_date(exif)
+            datedate = exifdate(info.exif)
             # Caso o metadado esteja como string, tentar converter em datetime.
             if isinstance(datedate, str) or isinstance(datedate, bool):
                 try:
@@ -1132,8 +1350,9 @@ class MainWindow(QMainWindow):
             else:
                 meta['date'] = datedate.strftime('%Y-%m-%d %H:%M:%S')
 
-        elif filename.endswith(video_extensions):
+        elif extension in FileFinder.videos:
             type = 'video'
+            imageinfo = None
             meta = {
                     'title': u'',
                     'tags': u'',
@@ -1205,28 +1424,36 @@ class MainWindow(QMainWindow):
         else:
             pass
 
-        self.createthumbs(filepath, type)
+        self.createthumbs(filepath, type, imageinfo)
 
         return entrymeta
 
-    def createthumbs(self, filepath, type):
-        '''Cria thumbnails para as fotos novas usando o PIL.'''
+    def createthumbs(self, filepath, type, imageinfo=None):
+        '''Cria thumbnails para as fotos novas usando o PIL.
+
+        imageinfo é o IPTCInfo.imageInfo da foto, lido junto com os
+        metadados. Com ele fotos grandes são decodificadas direto em escala
+        reduzida (draft), sem ler a imagem inteira em tamanho real.
+        '''
         hasdir(thumbdir)
         filename = os.path.basename(filepath)
-        thumbs = os.listdir(thumbdir)
-        thumbpath = os.path.join(thumbdir, filename)
-        #TODO Ver um bom jeito para comparar arquivos.
-        # try: hashlib, chunk and filecmp
+        thumbpath = self.thumbpath(filepath)
         if type == 'photo':
             size = 400, 400
-            copy(filepath, thumbdir)
-            self.changeStatus(u'%s copiado para %s' % (filename, thumbdir))
+            self.changeStatus(u'Criando thumbnail de %s em %s' % (filename,
+                thumbdir))
             try:
-                im = Image.open(thumbpath)
+                im = Image.open(filepath)
+                if imageinfo and imageinfo.get('width', 0) > 2 * size[0] \
+                        and imageinfo.get('height', 0) > 2 * size[1]:
+                    # Decodificador JPEG reduz 1/2, 1/4 ou 1/8 direto.
+                    im.draft(im.mode, size)
                 im.thumbnail(size, Image.ANTIALIAS)
                 im.save(thumbpath, 'JPEG')
                 logger.debug('Thumb %s criado!', thumbpath)
             except:
+                # Sem thumbnail, usa uma cópia da imagem.
+                copy(filepath, thumbpath)
                 logger.warning('Thumb %s não foi criado!', thumbpath)
 
         elif type == 'video':
@@ -1242,20 +1469,65 @@ class MainWindow(QMainWindow):
                 self.changeStatus(u'Não consegui criar o thumbnail...', 10000)
                 logger.warning('Thumb %s não foi criado! FFMpeg está instalado?', thumbpath)
 
+    def refreshfingerprints(self, todo=()):
+        '''Recalcula as impressões de arquivos gravados numa thread.
+
+        todo é uma lista de (caminho, thumbnail antigo). Os pedidos feitos
+        enquanto uma FingerprintThread trabalha esperam por ela.
+        '''
+        self.refresh_todo.extend(todo)
+        if not self.refresh_todo:
+            return
+        if self.refresher is not None and self.refresher.isRunning():
+            return
+        self.refresher = FingerprintThread(self, self.refresh_todo)
+        self.refresh_todo = []
+        self.connect(self.refresher, SIGNAL('refreshed(PyQt_PyObject)'),
+                self.refreshed)
+        self.refresher.start()
+
+    def refreshed(self, done):
+        '''Renomeia os thumbnails e atualiza a identidade das linhas.'''
+        for filepath, oldthumb in done:
+            self.model.reidentify(filepath)
+            newthumb = self.thumbpath(filepath)
+            if newthumb != oldthumb and os.path.exists(oldthumb):
+                try:
+                    os.rename(oldthumb, newthumb)
+                except OSError:
+                    logger.warning('Thumb %s não foi renomeado', oldthumb)
+        self.cachetable()
+        self.refreshfingerprints()
+
+    def thumbpath(self, filepath):
+        '''Caminho do thumbnail do arquivo.
+
+        O nome é a impressão rápida do conteúdo (veja Fingerprints), então
+        arquivos de mesmo nome em pastas diferentes têm thumbnails próprios.
+        Só consulta as impressões guardadas, calculadas pela ImportThread,
+        sem ler o arquivo; sem impressão usa o nome do arquivo, como nos
+        thumbnails antigos.
+        '''
+        quick = self.fingerprints.cached(filepath)
+        if quick is None:
+            return os.path.join(thumbdir, os.path.basename(filepath))
+        return os.path.join(thumbdir, quick + '.jpg')
+
     def matchfinder(self, candidate):
         '''Verifica se entrada já está na tabela.
 
-        O candidato pode ser o nome do arquivo (string) ou a entrada
-        selecionada da tabela (lista). Retorna uma lista com duplicatas ou
-        lista vazia caso nenhuma seja encontrada.
+        O candidato pode ser a identidade do arquivo (a impressão do
+        conteúdo, veja TableModel.identity), o caminho completo (string), o
+        nome do arquivo ou a entrada selecionada da tabela (lista). A
+        identidade e o caminho apontam uma linha; pelo nome podem vir
+        várias, de pastas diferentes. Retorna uma lista com duplicatas ou
+        lista vazia caso nenhuma seja encontrada. Usa os índices do
+        TableModel, sem percorrer a tabela nem ler os arquivos.
         '''
-        index = self.model.index(0, 0, QModelIndex())
         if isinstance(candidate, list):
-            value = os.path.basename(unicode(entry[0]))
-            matches = self.model.match(index, 0, value, -1, Qt.MatchContains)
-        else:
-            matches = self.model.match(index, 0, candidate, -1, Qt.MatchContains)
-        return matches
+            candidate = unicode(candidate[0])
+        return [self.model.index(row, 0, QModelIndex()) for row in
+                self.model.find_rows(candidate)]
 
     def delcurrent(self):
         '''Deleta a(s) entrada(s) selecionada(s) da tabela.
@@ -1274,12 +1546,11 @@ class MainWindow(QMainWindow):
             unsaved = []
             for row in indexes:
                 index = mainWidget.model.index(row, 0, QModelIndex())
-                filepath = mainWidget.model.data(index, Qt.DisplayRole)
-                filename = os.path.basename(unicode(filepath.toString()))
-                if filename in self.dockUnsaved.mylist:
-                    unsaved.append(filename)
-                else:
-                    continue
+                filepath = unicode(mainWidget.model.data(index,
+                    Qt.DisplayRole).toString())
+                key = self.dockUnsaved.findentry(filepath)
+                if key is not None:
+                    unsaved.append(key)
             #XXX Tem algum jeito de melhorar essa função? Repete sequência.
             if len(unsaved) > 0:
                 warning = QMessageBox.warning(
@@ -1368,6 +1639,14 @@ class MainWindow(QMainWindow):
         entries = self.dockRefs.model.mydata
         pickle.dump(entries, refscache)
         refscache.close()
+        # Manifesto
+        manifestcache = open(manifestpickle, 'wb')
+        pickle.dump(self.manifest, manifestcache)
+        manifestcache.close()
+        # Impressões dos arquivos
+        fingerprintcache = open(fingerprintpickle, 'wb')
+        pickle.dump(self.fingerprints.snapshot(), fingerprintcache)
+        fingerprintcache.close()
         # Lista
         listcache = open(listpickle, 'wb')
         entries = self.dockUnsaved.mylist
@@ -1383,8 +1662,9 @@ class MainWindow(QMainWindow):
             autolists[k] = comps
         pickle.dump(autolists, autocache)
         autocache.close()
-        logger.debug('Backup salvo nos arquivos: %s, %s, %s, %s', tablepickle,
-                refspickle, listpickle, autopickle)
+        logger.debug('Backup salvo nos arquivos: %s, %s, %s, %s, %s, %s',
+                tablepickle, refspickle, manifestpickle, fingerprintpickle,
+                listpickle, autopickle)
 
     def readsettings(self):
         '''Lê o estado anterior do aplicativo durante a inicialização.'''
@@ -1395,6 +1675,12 @@ class MainWindow(QMainWindow):
         self.move(settings.value('position', QPoint(200, 0)).toPoint())
         self.last_openfile = settings.value('openfile').toString()
         self.last_opendir = settings.value('opendir').toString()
+        self.finder.include = [unicode(pattern) for pattern in
+                settings.value('include', []).toStringList()]
+        self.finder.exclude = [unicode(pattern) for pattern in
+                settings.value('exclude', FileFinder.exclude).toStringList()]
+        for folder in settings.value('watched').toStringList():
+            self.watcher.add(unicode(folder))
         settings.endGroup()
 
     def writesettings(self):
@@ -1406,15 +1692,625 @@ class MainWindow(QMainWindow):
         settings.setValue('position', self.pos())
         settings.setValue('openfile', self.last_openfile)
         settings.setValue('opendir', self.last_opendir)
+        settings.setValue('include', self.finder.include)
+        settings.setValue('exclude', self.finder.exclude)
+        settings.setValue('watched', self.watcher.folders)
         settings.endGroup()
 
     def closeEvent(self, event):
         '''O que fazer quando o programa for fechado.'''
+        if self.importer is not None:
+            # Para a importação e entrega os lotes e o finished() que ficaram
+            # na fila: importfinished pega o manifesto de volta e refreshed
+            # renomeia os thumbnails dos arquivos gravados
+            self.importer.cancel()
+            self.importer.wait()
+        if self.refresher is not None:
+            self.refresher.wait()
+        if self.importer is not None or self.refresher is not None:
+            QCoreApplication.sendPostedEvents(self, QEvent.MetaCall)
         self.cachetable()
         self.writesettings()
         event.accept()
 
 
+class ImportThread(QThread):
+    '''Importa imagens fora da thread da interface.
+
+    Procura os arquivos nas pastas (além dos arquivos dados), lê os
+    metadados e cria os thumbnails (MainWindow.createmeta) num grupo de
+    threads. As entradas prontas vão para a interface em lotes, pelo sinal
+    imported(PyQt_PyObject); o número de imagens a importar pelo sinal
+    found(int) e o de imagens prontas por progress(int). Arquivos com o
+    mesmo conteúdo de um dos da tabela (paths) ou de outro já encontrado
+    são duplicados, qualquer que seja o nome (veja Fingerprints).
+
+    O manifest (caminho -> filesig) diz quais arquivos da tabela (paths)
+    mudaram desde a última importação: só estes são lidos de novo, e os
+    do manifesto que sumiram das pastas são retirados dele. A thread usa
+    uma cópia do manifesto, que a MainWindow pega de volta no fim.
+    '''
+    # Entradas por lote e segundos máximos entre lotes
+    batch = 50
+    interval = 0.5
+
+    def __init__(self, parent, filepaths=(), folders=(), paths=(),
+            manifest=None, workers=4):
+        QThread.__init__(self, parent)
+        self.parent = parent
+        self.finder = parent.finder
+        self.fingerprints = parent.fingerprints
+        self.filepaths = list(filepaths)
+        self.folders = list(folders)
+        self.paths = set(paths)
+        self.manifest = dict(manifest or {})
+        # Pastas que não puderam ser lidas na busca
+        self.failed = set()
+        self.workers = workers
+        self.cancelled = False
+        self.n_new = 0
+        self.n_dup = 0
+        self.n_changed = 0
+        self.n_same = 0
+        self.n_deleted = 0
+        self.n_error = 0
+
+    def cancel(self):
+        '''Para a importação; as imagens já prontas ficam na tabela.'''
+        self.cancelled = True
+
+    def discover(self, pool):
+        '''Lista (caminho, filesig) dos arquivos novos e modificados.
+
+        O stat dos arquivos das pastas vem do FileFinder; os que estão na
+        tabela com a mesma assinatura do manifesto não são lidos de novo.
+        As impressões dos arquivos novos são calculadas no pool.
+        '''
+        found = [(filepath, None) for filepath in self.filepaths]
+        if self.folders:
+            logger.info('Buscando imagens em %s', u', '.join(self.folders))
+        walker = self.finder.walk(self.folders, self.failed)
+        for filepath, st in walker:
+            if self.cancelled:
+                walker.close()
+                return []
+            found.append((filepath, st))
+        filepaths = [filepath for filepath, st in found]
+        self.forget(filepaths)
+        todo = []
+        candidates = []
+        for filepath, st in found:
+            try:
+                sig = filesig(filepath, st)
+            except OSError:
+                self.n_error += 1
+                continue
+            if filepath in self.paths:
+                if self.manifest.get(filepath) == sig:
+                    self.n_same += 1
+                else:
+                    logger.info('%s foi modificada.', filepath)
+                    todo.append((filepath, sig))
+            else:
+                candidates.append((filepath, sig))
+        if not candidates:
+            return todo
+        known = self.identities(pool)
+        for (filepath, sig), quick in zip(candidates,
+                pool.imap(self.identify, candidates)):
+            if self.cancelled:
+                return []
+            if quick is None:
+                self.n_error += 1
+                continue
+            twin = self.twin(filepath, known.get(quick, ()))
+            if twin is not None:
+                self.n_dup += 1
+                logger.info('%s é duplicada de %s.', filepath, twin)
+                continue
+            known.setdefault(quick, []).append(filepath)
+            todo.append((filepath, sig))
+        return todo
+
+    def identify(self, (filepath, sig)):
+        '''Impressão rápida do arquivo, None se não pôde ser lido.'''
+        try:
+            return self.fingerprints.quick(filepath, sig)
+        except (IOError, OSError):
+            return None
+
+    def identities(self, pool):
+        '''Impressões dos arquivos da tabela: impressão -> caminhos.
+
+        Usa as guardadas, mesmo de arquivos modificados depois; só as dos
+        arquivos que nunca passaram pelo Fingerprints são calculadas.
+        '''
+        known = {}
+        missing = []
+        for filepath in self.paths:
+            quick = self.fingerprints.cached(filepath)
+            if quick is None:
+                missing.append((filepath, None))
+            else:
+                known.setdefault(quick, []).append(filepath)
+        for (filepath, sig), quick in zip(missing,
+                pool.imap(self.identify, missing)):
+            if quick is not None:
+                known.setdefault(quick, []).append(filepath)
+        return known
+
+    def twin(self, filepath, others):
+        '''Primeiro dos outros arquivos com o mesmo conteúdo, ou None.'''
+        for other in others:
+            try:
+                if self.fingerprints.same(filepath, other):
+                    return other
+            except (IOError, OSError):
+                continue
+        return None
+
+    def forget(self, filepaths):
+        '''Tira do manifesto os arquivos das pastas que não existem mais.
+
+        Os das pastas que não puderam ser lidas (failed) ficam: uma pasta
+        desmontada não quer dizer que os arquivos foram apagados.
+        '''
+        found = set(filepaths)
+        prefixes = tuple([os.path.join(folder, '') for folder in self.folders])
+        if not prefixes:
+            return
+        unread = tuple([os.path.join(folder, '') for folder in self.failed])
+        for filepath in self.manifest.keys():
+            if unread and filepath.startswith(unread):
+                continue
+            if filepath.startswith(prefixes) and filepath not in found:
+                del self.manifest[filepath]
+                self.fingerprints.discard(filepath)
+                self.n_deleted += 1
+                logger.info('%s foi apagada.', filepath)
+
+    def createmeta(self, (filepath, sig)):
+        '''(Entrada da tabela, filesig), entrada None se deu erro.
+
+        Calcula antes a impressão do arquivo, que dá nome ao thumbnail.
+        '''
+        try:
+            self.fingerprints.quick(filepath, sig)
+            entrymeta = self.parent.createmeta(filepath)
+        except Exception:
+            logger.warning('Erro ao importar %s', filepath)
+            return None, sig
+        logger.info('%s foi importada.', filepath)
+        return entrymeta, sig
+
+    def run(self):
+        '''Busca, importa e manda as entradas em lotes.'''
+        pool = ThreadPool(self.workers)
+        batch = []
+        n_done = 0
+        try:
+            todo = self.discover(pool)
+            self.emit(SIGNAL('found(int)'), len(todo))
+            hasdir(thumbdir)
+            last = time.time()
+            for entrymeta, sig in pool.imap(self.createmeta, todo):
+                n_done += 1
+                if entrymeta is None:
+                    self.n_error += 1
+                    continue
+                batch.append(entrymeta)
+                self.manifest[entrymeta[0]] = sig
+                if entrymeta[0] in self.paths:
+                    self.n_changed += 1
+                else:
+                    self.n_new += 1
+                if len(batch) >= self.batch or \
+                        time.time() - last > self.interval:
+                    self.emit(SIGNAL('imported(PyQt_PyObject)'), batch)
+                    self.emit(SIGNAL('progress(int)'), n_done)
+                    batch = []
+                    last = time.time()
+                if self.cancelled:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        if batch:
+            self.emit(SIGNAL('imported(PyQt_PyObject)'), batch)
+        self.emit(SIGNAL('progress(int)'), n_done)
+
+
+class FingerprintThread(QThread):
+    '''Recalcula as impressões de arquivos gravados (veja Fingerprints).
+
+    Lê 128 KB de cada arquivo, então fica fora da thread da interface. Os
+    (caminho, thumbnail antigo) dos arquivos que puderam ser lidos voltam
+    pelo sinal refreshed(PyQt_PyObject).
+    '''
+    def __init__(self, parent, todo):
+        QThread.__init__(self, parent)
+        self.fingerprints = parent.fingerprints
+        self.todo = list(todo)
+
+    def run(self):
+        '''Calcula as impressões e manda a lista dos prontos.'''
+        done = []
+        for filepath, oldthumb in self.todo:
+            try:
+                self.fingerprints.quick(filepath)
+            except (IOError, OSError):
+                logger.warning('Impressão de %s não foi calculada', filepath)
+                continue
+            done.append((filepath, oldthumb))
+        self.emit(SIGNAL('refreshed(PyQt_PyObject)'), done)
+
+
+class Fingerprints(object):
+    '''Identidade dos arquivos pelo conteúdo.
+
+    A impressão rápida é o sha1 do tamanho com os primeiros e os últimos
+    64 KB do arquivo, o que basta para arquivos até 128 KB. Arquivos
+    maiores só têm a mesma impressão rápida se diferirem apenas no meio;
+    same() então compara o sha1 do arquivo inteiro, lido em blocos. As
+    impressões ficam guardadas por caminho junto com o filesig e só são
+    calculadas de novo quando o arquivo muda. Pode ser usado por várias
+    threads.
+    '''
+    chunk = 64 * 1024
+
+    def __init__(self, cache=None):
+        # caminho -> [filesig, impressão rápida, sha1 completo ou None]
+        if cache is None:
+            cache = {}
+        self.cache = cache
+        self.lock = Lock()
+
+    def entry(self, filepath, sig=None):
+        '''Entrada do cache, calculada de novo se o arquivo mudou.'''
+        if sig is None:
+            sig = filesig(filepath)
+        with self.lock:
+            entry = self.cache.get(filepath)
+        if entry is None or entry[0] != sig:
+            entry = [sig, self.quickhash(filepath, sig[0]), None]
+            with self.lock:
+                self.cache[filepath] = entry
+        return entry
+
+    def quick(self, filepath, sig=None):
+        '''Impressão rápida do arquivo.'''
+        return self.entry(filepath, sig)[1]
+
+    def full(self, filepath, sig=None):
+        '''Sha1 do arquivo inteiro (a impressão rápida, até 128 KB).'''
+        entry = self.entry(filepath, sig)
+        if entry[0][0] <= 2 * self.chunk:
+            return entry[1]
+        if entry[2] is None:
+            entry[2] = self.fullhash(filepath)
+        return entry[2]
+
+    def same(self, filepath, other):
+        '''Verdadeiro se os dois arquivos têm o mesmo conteúdo.'''
+        if self.quick(filepath) != self.quick(other):
+            return False
+        return self.full(filepath) == self.full(other)
+
+    def cached(self, filepath):
+        '''Impressão rápida guardada, sem olhar o arquivo; None se não há.'''
+        with self.lock:
+            entry = self.cache.get(filepath)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def discard(self, filepath):
+        '''Esquece a impressão do arquivo (apagado).'''
+        with self.lock:
+            self.cache.pop(filepath, None)
+
+    def snapshot(self):
+        '''Cópia do cache com as entradas que têm filesig, para o pickle.'''
+        with self.lock:
+            return dict([(filepath, entry) for filepath, entry in
+                self.cache.iteritems() if isinstance(entry[0], tuple) and
+                len(entry[0]) == 3])
+
+    def quickhash(self, filepath, size):
+        '''Sha1 do tamanho, dos primeiros e dos últimos 64 KB.'''
+        digest = sha1(str(size))
+        f = open(filepath, 'rb')
+        try:
+            digest.update(f.read(self.chunk))
+            if size > 2 * self.chunk:
+                f.seek(-self.chunk, 2)
+            digest.update(f.read(self.chunk))
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+    def fullhash(self, filepath):
+        '''Sha1 do arquivo inteiro.'''
+        digest = sha1()
+        f = open(filepath, 'rb')
+        try:
+            for block in iter(lambda: f.read(16 * self.chunk), ''):
+                digest.update(block)
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+
+class FileFinder(object):
+    '''Procura imagens e vídeos nas pastas e subpastas.
+
+    Cada pasta é listada uma só vez, com scandir quando disponível, num
+    grupo de threads: cada subpasta entra na fila assim que aparece, então
+    uma pasta lenta (em pastas de rede cada listagem espera pelo servidor)
+    não segura as outras. As extensões são comparadas em minúsculas, então
+    .Jpg também vale. Pastas e arquivos cujo nome casa com um padrão de
+    exclude (fnmatch) são ignorados; padrões terminados em / valem só para
+    pastas. Havendo padrões de include, só entram os arquivos que casam
+    com algum deles.
+    '''
+    photos = frozenset(['jpg', 'jpeg'])
+    videos = frozenset(['avi', 'mov', 'mp4', 'ogg', 'ogv', 'dv', 'mpg',
+        'mpeg', 'flv', 'm2ts', 'wmv'])
+    extensions = photos | videos
+    # Pastas ocultas (.git) e a dos thumbnails; arquivos ocultos entram
+    exclude = ['.*/', 'thumbs/']
+
+    def __init__(self, include=(), exclude=None, workers=8):
+        self.include = list(include)
+        if exclude is None:
+            exclude = self.exclude
+        self.exclude = list(exclude)
+        self.workers = workers
+
+    def skips(self, name, folder=False):
+        '''Verdadeiro se o nome casa com algum padrão de exclude.
+
+        Os padrões terminados em / só casam com pastas (folder=True).
+        '''
+        for pattern in self.exclude:
+            if pattern.endswith('/'):
+                if not folder:
+                    continue
+                pattern = pattern[:-1]
+            if fnmatch(name, pattern):
+                return True
+        return False
+
+    def wants(self, name):
+        '''Verdadeiro se o arquivo deve ser importado.'''
+        if fileext(name) not in self.extensions or self.skips(name):
+            return False
+        if not self.include:
+            return True
+        for pattern in self.include:
+            if fnmatch(name, pattern):
+                return True
+        return False
+
+    def listdir(self, folder):
+        '''Retorna os arquivos, como (caminho, stat), e as subpastas.
+
+        Como o os.walk, não entra em links para pastas. Retorna None se a
+        pasta não pôde ser lida (apagada, sem permissão ou desmontada);
+        arquivos que sumiram durante a listagem ficam de fora.
+        '''
+        files = []
+        folders = []
+        try:
+            if scandir is not None:
+                entries = scandir(folder)
+            else:
+                entries = os.listdir(folder)
+        except OSError:
+            logger.warning('Não foi possível ler a pasta %s', folder)
+            return None
+        for entry in entries:
+            try:
+                if scandir is not None:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not self.skips(entry.name, folder=True):
+                            folders.append(entry.path)
+                    elif self.wants(entry.name) and entry.is_file():
+                        files.append((entry.path, entry.stat()))
+                    continue
+                path = os.path.join(folder, entry)
+                st = os.lstat(path)
+                if S_ISDIR(st.st_mode):
+                    if not self.skips(entry, folder=True):
+                        folders.append(path)
+                    continue
+                if not self.wants(entry):
+                    continue
+                if S_ISLNK(st.st_mode):
+                    st = os.stat(path)
+                    if S_ISDIR(st.st_mode):
+                        continue
+                files.append((path, st))
+            except OSError:
+                continue
+        return files, folders
+
+    def listfolder(self, folder):
+        '''(pasta, listdir da pasta), para o pool do walk.
+
+        Nunca levanta exceção: o walk espera uma resposta por pasta.
+        '''
+        try:
+            return folder, self.listdir(folder)
+        except Exception:
+            logger.exception('Erro ao listar a pasta %s', folder)
+            return folder, None
+
+    def walk(self, folders, failed=None):
+        '''Gera (caminho, stat) dos arquivos das pastas e subpastas.
+
+        As pastas vão para o pool uma a uma e os arquivos saem na ordem em
+        que as listagens ficam prontas. As pastas que não puderam ser lidas
+        vão para o conjunto failed.
+        '''
+        pool = ThreadPool(self.workers)
+        done = Queue()
+        pending = 0
+        try:
+            for folder in folders:
+                pool.apply_async(self.listfolder, (folder,),
+                        callback=done.put)
+                pending += 1
+            while pending:
+                folder, listing = done.get()
+                pending -= 1
+                if listing is None:
+                    if failed is not None:
+                        failed.add(folder)
+                    continue
+                files, found = listing
+                for subfolder in found:
+                    pool.apply_async(self.listfolder, (subfolder,),
+                            callback=done.put)
+                    pending += 1
+                for item in files:
+                    yield item
+        finally:
+            pool.terminate()
+
+
+class FolderWatcher(QObject):
+    '''Vigia pastas e importa as imagens novas ou modificadas nelas.
+
+    Cada pasta e subpasta é registrada num QFileSystemWatcher, que avisa
+    quando arquivos são criados, apagados ou renomeados nela. Os avisos são
+    acumulados e só quando passam debounce segundos sem avisos as pastas
+    avisadas são listadas, sem descer nas subpastas. Arquivos cujo filesig
+    mudou desde a listagem anterior ainda estão sendo copiados e esperam a
+    próxima; os que pararam de mudar e diferem do manifesto vão para
+    MainWindow.startimport.
+    '''
+    debounce = 2.0
+
+    def __init__(self, parent):
+        QObject.__init__(self, parent)
+        self.parent = parent
+        self.folders = []
+        self.watcher = QFileSystemWatcher(self)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(int(self.debounce * 1000))
+        # Pastas avisadas e ainda não listadas
+        self.pending = set()
+        # Assinaturas da última listagem dos arquivos em cópia
+        self.growing = {}
+        # Assinaturas dos arquivos mandados para importar e que ainda não
+        # estão no manifesto
+        self.sent = {}
+
+        self.connect(self.watcher, SIGNAL('directoryChanged(QString)'),
+                self.changed)
+        self.connect(self.timer, SIGNAL('timeout()'), self.scan)
+
+    def add(self, folder):
+        '''Vigia a pasta e suas subpastas; False se ela já é vigiada.'''
+        folder = os.path.abspath(folder)
+        if folder in self.folders or not os.path.isdir(folder):
+            return False
+        self.folders.append(folder)
+        self.watch(folder)
+        logger.info('Vigiando %s', folder)
+        return True
+
+    def remove(self, folder):
+        '''Deixa de vigiar a pasta e suas subpastas.'''
+        self.folders.remove(folder)
+        inside = lambda path: path == folder or path.startswith(
+                os.path.join(folder, ''))
+        paths = [path for path in self.directories() if inside(path)]
+        if paths:
+            self.watcher.removePaths(paths)
+        self.pending = set([path for path in self.pending if not
+            inside(path)])
+        self.prune(inside)
+        logger.info('Deixando de vigiar %s', folder)
+
+    def prune(self, gone):
+        '''Esquece os arquivos para os quais gone(caminho) é verdadeiro.'''
+        for files in (self.sent, self.growing):
+            for filepath in files.keys():
+                if gone(filepath):
+                    del files[filepath]
+
+    def directories(self):
+        '''Pastas registradas no watcher.'''
+        return [unicode(path) for path in self.watcher.directories()]
+
+    def watch(self, folder):
+        '''Registra a pasta e as subpastas; retorna a lista delas.'''
+        folders = []
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [name for name in dirs if not
+                    self.parent.finder.skips(name, folder=True)]
+            folders.append(root)
+        self.watcher.addPaths(folders)
+        return folders
+
+    def changed(self, folder):
+        '''Aviso do watcher: lista a pasta quando os avisos pararem.'''
+        self.pending.add(unicode(folder))
+        self.timer.start()
+
+    def scan(self):
+        '''Lista as pastas avisadas e importa os arquivos prontos.'''
+        importer = self.parent.importer
+        if importer is not None and importer.isRunning():
+            self.timer.start()
+            return
+        pending = self.pending
+        self.pending = set()
+        growing = {}
+        ready = []
+        watched = set(self.directories())
+        for folder in pending:
+            listing = self.parent.finder.listdir(folder)
+            if listing is None:
+                # Pasta apagada
+                prefix = os.path.join(folder, '')
+                self.prune(lambda path: path.startswith(prefix))
+                continue
+            files, subfolders = listing
+            # Arquivos apagados ou renomeados desde a última listagem
+            present = set([filepath for filepath, st in files])
+            self.prune(lambda path: path not in present and
+                    os.path.dirname(path) == folder)
+            for subfolder in subfolders:
+                if subfolder not in watched:
+                    # Pasta nova: vigia e lista na próxima rodada
+                    self.pending.update(self.watch(subfolder))
+            for filepath, st in files:
+                sig = filesig(filepath, st)
+                if sig == self.parent.manifest.get(filepath):
+                    # Importado: o manifesto já basta
+                    self.sent.pop(filepath, None)
+                    continue
+                if sig == self.sent.get(filepath):
+                    continue
+                if self.growing.get(filepath) == sig:
+                    ready.append(filepath)
+                    self.sent[filepath] = sig
+                else:
+                    growing[filepath] = sig
+                    self.pending.add(folder)
+        self.growing = growing
+        if self.pending:
+            self.timer.start()
+        if ready:
+            logger.info('%d imagens novas ou modificadas nas pastas vigiadas',
+                    len(ready))
+            self.parent.startimport(filepaths=ready, progress=False)
+
+
 class RightClickMenu(QMenu):
     '''Menu que aparece com o botão direito.'''
     def __init__(self, parent):
@@ -1510,6 +2406,7 @@ class RightClickMenu(QMenu):
         if result == QMessageBox.Ok:
             yes = 0
             no = 0
+            same = 0
             for filepath in filepaths:
                 values[0] = filepath
                 wrote = self.parent.writemeta(values)
@@ -1517,10 +2414,15 @@ class RightClickMenu(QMenu):
                     yes += 1
                     self.parent.changeStatus(u'%s atualizado!' % filepath)
                     logger.debug('%s atualizado!', filepath)
+                elif wrote == SKIPPED:
+                    same += 1
+                    logger.debug('%s sem alterações!', filepath)
                 else:
                     logger.debug('%s erro!', filepath)
                     no += 1
-            self.parent.changeStatus(u'Sucesso! %d arquivos atualizados!' % yes)
+            self.parent.changeStatus(
+                    u'Sucesso! %d arquivos atualizados, %d sem alterações!' %
+                    (yes, same))
 
 
 class ManualDialog(QDialog):
@@ -1848,6 +2750,118 @@ class TableModel(QAbstractTableModel):
         self.parent = parent
         self.mydata = mydata
         self.header = header
+        # Índices caminho -> linha, nome do arquivo -> linhas e identidade
+        # -> linha, feitos na primeira busca e mantidos em dia pelas
+        # inserções, remoções, edições da coluna 0 e ordenações.
+        self.pathindex = None
+        self.nameindex = None
+        self.idindex = None
+        # Função caminho -> identidade (impressão do conteúdo) ou None, sem
+        # ler o arquivo (Fingerprints.cached); a identidade de cada caminho
+        # é a da hora em que entrou no índice, até reidentify.
+        self.identify = None
+        self.ids = {}
+
+    def buildindex(self):
+        '''Indexa as linhas pelo caminho, nome e identidade do arquivo.'''
+        self.pathindex = {}
+        self.nameindex = {}
+        self.idindex = {}
+        for row, entry in enumerate(self.mydata):
+            self.addindex(row, entry)
+
+    def addindex(self, row, entry):
+        '''Acrescenta a linha aos índices.'''
+        filepath = unicode(entry[0])
+        self.pathindex[filepath] = row
+        self.nameindex.setdefault(os.path.basename(filepath), []).append(row)
+        key = self.ids.get(filepath)
+        if key is None and self.identify is not None:
+            key = self.identify(filepath)
+        if key is not None:
+            self.ids[filepath] = key
+            self.idindex[key] = row
+
+    def dropindex(self, row, filepath):
+        '''Tira dos índices a linha com o arquivo dado.'''
+        filepath = unicode(filepath)
+        if self.pathindex.get(filepath) == row:
+            del self.pathindex[filepath]
+            key = self.ids.pop(filepath, None)
+            if key is not None and self.idindex.get(key) == row:
+                del self.idindex[key]
+        filename = os.path.basename(filepath)
+        rows = self.nameindex.get(filename)
+        if rows and row in rows:
+            rows.remove(row)
+            if not rows:
+                del self.nameindex[filename]
+
+    def moveindex(self, old, new, filepath):
+        '''Muda nos índices o número da linha do arquivo dado.'''
+        filepath = unicode(filepath)
+        if self.pathindex.get(filepath) == old:
+            self.pathindex[filepath] = new
+            key = self.ids.get(filepath)
+            if key is not None and self.idindex.get(key) == old:
+                self.idindex[key] = new
+        rows = self.nameindex.get(os.path.basename(filepath))
+        if rows and old in rows:
+            rows[rows.index(old)] = new
+
+    def filepaths(self):
+        '''Caminhos dos arquivos que estão na tabela.'''
+        if self.pathindex is None:
+            self.buildindex()
+        return self.pathindex.keys()
+
+    def identity(self, filepath):
+        '''Identidade do arquivo na tabela; o caminho se não houver.'''
+        if self.pathindex is None:
+            self.buildindex()
+        filepath = unicode(filepath)
+        return self.ids.get(filepath, filepath)
+
+    def reidentify(self, filepath):
+        '''Troca a identidade da linha pela atual (o conteúdo mudou).'''
+        if self.pathindex is None:
+            self.buildindex()
+        filepath = unicode(filepath)
+        row = self.pathindex.get(filepath)
+        if row is None:
+            return
+        self.dropindex(row, filepath)
+        self.addindex(row, self.mydata[row])
+
+    def update_entry(self, entry):
+        '''Substitui a linha do arquivo da entrada; False se não houver.'''
+        if self.pathindex is None:
+            self.buildindex()
+        row = self.pathindex.get(unicode(entry[0]))
+        if row is None:
+            return False
+        self.mydata[row] = entry
+        self.reidentify(entry[0])
+        self.emit(SIGNAL('dataChanged(QModelIndex, QModelIndex)'),
+                self.index(row, 0, QModelIndex()),
+                self.index(row, len(entry) - 1, QModelIndex()))
+        return True
+
+    def find_rows(self, candidate):
+        '''Linhas cujo arquivo é o candidato.
+
+        O candidato pode ser a identidade, o caminho completo ou só o nome
+        do arquivo, que precisa ser igual (IMG_1.jpg não encontra
+        IMG_12.jpg).
+        '''
+        if self.pathindex is None:
+            self.buildindex()
+        candidate = unicode(candidate)
+        if candidate in self.pathindex:
+            return [self.pathindex[candidate]]
+        if candidate in self.idindex:
+            return [self.idindex[candidate]]
+        return list(self.nameindex.get(candidate, []))
 
     def rowCount(self, parent):
         '''Conta as linhas.'''
@@ -1894,6 +2908,9 @@ class TableModel(QAbstractTableModel):
                         value.toString()).lower()
             else:
                 self.mydata[index.row()][index.column()] = value.toString()
+                if index.column() == 0 and self.pathindex is not None:
+                    self.dropindex(index.row(), oldvalue)
+                    self.addindex(index.row(), self.mydata[index.row()])
             self.emit(SIGNAL('dataChanged(PyQt_PyObject, PyQt_PyObject, PyQt_PyObject)'),
                     index, value, oldvalue)
             return True
@@ -1905,6 +2922,8 @@ class TableModel(QAbstractTableModel):
         self.mydata = sorted(self.mydata, key=operator.itemgetter(col))
         if order == Qt.DescendingOrder:
             self.mydata.reverse()
+        if self.pathindex is not None:
+            self.buildindex()
         self.emit(SIGNAL('layoutChanged()'))
 
     def insert_rows(self, position, rows, parent, entry):
@@ -1912,14 +2931,44 @@ class TableModel(QAbstractTableModel):
         self.beginInsertRows(parent, position, position + rows - 1)
         for row in xrange(rows):
             self.mydata.append(entry)
+            if self.pathindex is not None:
+                self.addindex(len(self.mydata) - 1, entry)
+        self.endInsertRows()
+        return True
+
+    def insert_entries(self, entries, parent=None):
+        '''Insere várias entradas no fim da tabela.
+
+        Usa um só par beginInsertRows/endInsertRows, então as views reagem
+        uma vez por lote e não uma vez por entrada.
+        '''
+        if not entries:
+            return False
+        if parent is None:
+            parent = QModelIndex()
+        first = len(self.mydata)
+        self.beginInsertRows(parent, first, first + len(entries) - 1)
+        for entry in entries:
+            self.mydata.append(entry)
+            if self.pathindex is not None:
+                self.addindex(len(self.mydata) - 1, entry)
         self.endInsertRows()
         return True
 
     def remove_rows(self, position, rows, parent):
-        '''Remove entrada da tabela.'''
+        '''Remove entrada da tabela.
+
+        Os índices perdem as linhas removidas e as seguintes sobem; só as
+        linhas depois de position são percorridas.
+        '''
         self.beginRemoveRows(parent, position, position + rows - 1)
-        for row in xrange(rows):
-            self.mydata.pop(position)
+        removed = self.mydata[position:position + rows]
+        del self.mydata[position:position + rows]
+        if self.pathindex is not None:
+            for offset, entry in enumerate(removed):
+                self.dropindex(position + offset, entry[0])
+            for row in xrange(position, len(self.mydata)):
+                self.moveindex(row + rows, row, self.mydata[row][0])
         self.endRemoveRows()
         return True
 
@@ -2351,14 +3400,7 @@ class DockGeo(QWidget):
 
     def gps_string(self, gps):
         '''Transforma coordenadas extraídas do exif em texto.'''
-        dms_str = {}
-        dms_str['lat'] = u'%s %02d°%02d\'%02d"' % (
-                gps['latref'], gps['latdeg'],
-                gps['latmin'], gps['latsec'])
-        dms_str['long'] = u'%s %03d°%02d\'%02d"' % (
-                gps['longref'], gps['longdeg'],
-                gps['longmin'], gps['longsec'])
-        return dms_str
+        return gpsstring(gps)
 
     def setdms(self, dms):
         '''Atualiza as coordenadas do editor e da tabela.'''
@@ -2529,41 +3571,13 @@ class DockGeo(QWidget):
             # Imagem sem coordenadas
             self.write_html(unset=1, zoom=1)
 
-    def get_exif(self, filepath):
-        '''Extrai o exif da imagem selecionada usando o pyexiv2 0.3.0.'''
-        exif_meta = pyexiv2.ImageMetadata(unicode(filepath))
-        exif_meta.read()
-        return exif_meta
-
-    def get_gps(self, exif_meta):
-        '''Extrai gps do exif.'''
-        gps = {}
-        try:
-            gps['latref'] = exif_meta['Exif.GPSInfo.GPSLatitudeRef'].value
-            gps['latdeg'] = exif_meta['Exif.GPSInfo.GPSLatitude'].value[0]
-            gps['latmin'] = exif_meta['Exif.GPSInfo.GPSLatitude'].value[1]
-            gps['latsec'] = exif_meta['Exif.GPSInfo.GPSLatitude'].value[2]
-            gps['longref'] = exif_meta['Exif.GPSInfo.GPSLongitudeRef'].value
-            gps['longdeg'] = exif_meta['Exif.GPSInfo.GPSLongitude'].value[0]
-            gps['longmin'] = exif_meta['Exif.GPSInfo.GPSLongitude'].value[1]
-            gps['longsec'] = exif_meta['Exif.GPSInfo.GPSLongitude'].value[2]
-            return gps
-        except:
-            return gps
+    def get_gps(self, exif):
+        '''Extrai gps do exif (veja exifgps).'''
+        return exifgps(exif)
 
     def get_date(self, exif):
-        '''Extrai a data em que foi criada a foto do EXIF.'''
-        try:
-            date = exif['Exif.Photo.DateTimeOriginal']
-        except:
-            try:
-                date = exif['Exif.Photo.DateTimeDigitized']
-            except:
-                try:
-                    date = exif['Exif.Image.DateTime']
-                except:
-                    return False
-        return date.value
+        '''Extrai a data em que foi criada a foto do EXIF (veja exifdate).'''
+        return exifdate(exif)
 
     def resolve(self, frac):
         '''Resolve a fração das coordenadas para int.
@@ -2641,13 +3655,13 @@ class DockGeo(QWidget):
         long = re.findall('\w+', longitude)
         gps = {
                 'latref': lat[0],
-                'latdeg': pyexiv2.utils.Rational(lat[1], 1),
-                'latmin': pyexiv2.utils.Rational(lat[2], 1),
-                'latsec': pyexiv2.utils.Rational(lat[3], 1),
+                'latdeg': Fraction(int(lat[1]), 1),
+                'latmin': Fraction(int(lat[2]), 1),
+                'latsec': Fraction(int(lat[3]), 1),
                 'longref': long[0],
-                'longdeg': pyexiv2.utils.Rational(long[1], 1),
-                'longmin': pyexiv2.utils.Rational(long[2], 1),
-                'longsec': pyexiv2.utils.Rational(long[3], 1),
+                'longdeg': Fraction(int(long[1]), 1),
+                'longmin': Fraction(int(long[2]), 1),
+                'longsec': Fraction(int(long[3]), 1),
                 }
         return gps
 
@@ -3004,12 +4018,15 @@ class DockThumb(QWidget):
 
     def pixmapcache(self, filepath):
         '''Cria cache para thumbnail.'''
-        filename = os.path.basename(unicode(filepath))
-        thumbpath = os.path.join(thumbdir, filename)
+        filepath = unicode(filepath)
+        thumbpath = self.parent.thumbpath(filepath)
+        if not os.path.exists(thumbpath):
+            # Thumbnail antigo, com o nome do arquivo
+            thumbpath = os.path.join(thumbdir, os.path.basename(filepath))
         # Tenta abrir o cache
-        if not QPixmapCache.find(filename, self.pic):
+        if not QPixmapCache.find(thumbpath, self.pic):
             self.pic.load(thumbpath)
-            QPixmapCache.insert(filename, self.pic)
+            QPixmapCache.insert(thumbpath, self.pic)
         else:
             pass
         return self.pic
@@ -3071,6 +4088,9 @@ class DockUnsaved(QWidget):
 
         self.mylist = updatelist
         self.model = ListModel(self, self.mylist)
+        # Entrada da lista -> identidade do arquivo na tabela
+        self.keys = dict([(entry, mainWidget.model.identity(entry)) for
+            entry in self.mylist])
 
         self.view = QListView()
         self.view.setModel(self.model)
@@ -3119,27 +4139,44 @@ class DockUnsaved(QWidget):
         '''Insere entrada na lista.
 
         Checa se a modificação não foi nula (valor atual == valor anterior) e
-        se a entrada é duplicada.
+        se a entrada é duplicada. A lista mostra o caminho completo e é
+        indexada pela identidade do arquivo (veja TableModel.identity), que
+        distingue arquivos de mesmo nome em pastas diferentes.
         '''
         if value == oldvalue:
             pass
         else:
             index = mainWidget.model.index(index.row(), 0, QModelIndex())
             filepath = mainWidget.model.data(index, Qt.DisplayRole)
-            filename = os.path.basename(unicode(filepath.toString()))
-            matches = self.matchfinder(filename)
-            if len(matches) == 0:
-                self.model.insert_rows(0, 1, QModelIndex(), filename)
+            filepath = unicode(filepath.toString())
+            if self.findentry(filepath) is None:
+                self.model.insert_rows(0, 1, QModelIndex(), filepath)
+                self.keys[filepath] = mainWidget.model.identity(filepath)
                 self.savebutton.setEnabled(True)
             else:
                 pass
 
+    def findentry(self, filepath):
+        '''Entrada da lista do arquivo da tabela, None se não estiver.
+
+        Compara pela identidade; listas antigas guardavam só o nome.
+        '''
+        key = mainWidget.model.identity(filepath)
+        for entry, identity in self.keys.iteritems():
+            if identity == key:
+                return entry
+        filename = os.path.basename(unicode(filepath))
+        if filename in self.keys:
+            return filename
+        return None
+
     def delentry(self, filename):
         '''Remove entrada da lista.'''
         matches = self.matchfinder(filename)
         if len(matches) == 1:
             match = matches[0]
             self.model.remove_rows(match.row(), 1, QModelIndex())
+            self.keys.pop(unicode(filename), None)
             if not self.model.mylist:
                 self.savebutton.setDisabled(True)
 
@@ -3148,6 +4185,7 @@ class DockUnsaved(QWidget):
         rows = self.model.rowCount(self.model)
         if rows > 0:
             self.model.remove_rows(0, rows, QModelIndex())
+            self.keys.clear()
             self.savebutton.setDisabled(True)
         else:
             self.parent.changeStatus('Nada pra deletar.')
@@ -3205,9 +4243,13 @@ def initialize():
     global tablepickle
     global refspickle
     global listpickle
+    global manifestpickle
+    global fingerprintpickle
     global autopickle
     global header
     global datalist
+    global manifest
+    global fingerprints
     global updatelist
     global refslist
     global autolists
@@ -3261,6 +4303,30 @@ def initialize():
             u'', u'', u'',
             ], ]
 
+    # Nome do arquivo Pickle para o manifesto das imagens importadas
+    manifestpickle = '.manifest'
+    try:
+        manifestcache = open(manifestpickle, 'rb')
+        manifest = pickle.load(manifestcache)
+        manifestcache.close()
+    except:
+        logger.debug('Arquivo .manifest não existe, criando novo.')
+        f = open(manifestpickle, 'wb')
+        f.close()
+        manifest = seedmanifest(datalist)
+
+    # Nome do arquivo Pickle para as impressões dos arquivos (Fingerprints)
+    fingerprintpickle = '.fingerprints'
+    try:
+        fingerprintcache = open(fingerprintpickle, 'rb')
+        fingerprints = pickle.load(fingerprintcache)
+        fingerprintcache.close()
+    except:
+        logger.debug('Arquivo .fingerprints não existe, criando novo.')
+        f = open(fingerprintpickle, 'wb')
+        f.close()
+        fingerprints = {}
+
     # Nome do arquivo Pickle para lista
     listpickle = '.listcache'
     try:
@@ -3325,6 +4391,77 @@ def hasdir(folder):
         os.mkdir(folder)
 
 
+def exifgps(exif):
+    '''Extrai gps do exif.
+
+    Recebe o dicionário IPTCInfo.exif (ou o caminho da imagem, lido com
+    iptcinfo.readExif), com os nomes das tags do exiv2.
+    '''
+    if isinstance(exif, basestring):
+        exif = readExif(exif, c_exif_gps)
+    return gpsInfo(exif)
+
+
+def exifdate(exif):
+    '''Extrai a data em que foi criada a foto do EXIF.'''
+    if isinstance(exif, basestring):
+        exif = readExif(exif, c_exif_dates)
+    for key in ('Exif.Photo.DateTimeOriginal',
+            'Exif.Photo.DateTimeDigitized', 'Exif.Image.DateTime'):
+        if key in exif:
+            return exif[key]
+    return False
+
+
+def gpsstring(gps):
+    '''Transforma coordenadas extraídas do exif em texto.'''
+    dms_str = {}
+    dms_str['lat'] = u'%s %02d°%02d\'%02d"' % (
+            gps['latref'], gps['latdeg'],
+            gps['latmin'], gps['latsec'])
+    dms_str['long'] = u'%s %03d°%02d\'%02d"' % (
+            gps['longref'], gps['longdeg'],
+            gps['longmin'], gps['longsec'])
+    return dms_str
+
+
+def fileext(filename):
+    '''Extensão do arquivo em minúsculas e sem o ponto.'''
+    return os.path.splitext(filename)[1][1:].lower()
+
+
+def filesig(filepath, st=None):
+    '''Assinatura (tamanho, mtime em ns, inode) do arquivo, para o manifesto.
+
+    Usa o stat dado, se houver, em vez de ler o do arquivo.
+    '''
+    if st is None:
+        st = os.stat(filepath)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime_ns, st.st_ino)
+
+
+def seedmanifest(entries):
+    '''Manifesto das entradas da tabela, com o filesig atual dos arquivos.
+
+    Para quando não há .manifest (tabela de uma versão anterior): sem ele
+    todas as imagens da tabela seriam reimportadas como modificadas. Os
+    arquivos que não existem mais ficam de fora.
+    '''
+    manifest = {}
+    for entry in entries:
+        filepath = unicode(entry[0])
+        if not filepath:
+            continue
+        try:
+            manifest[filepath] = filesig(filepath)
+        except OSError:
+            continue
+    return manifest
+
+
 def debug_trace():
     '''Set a tracepoint in the Python debugger that works with Qt'''
     from PyQt4.QtCore import pyqtRemoveInputHook